@@ -1,17 +1,30 @@
+import os
+import random
+import signal
+import socket
+import sqlite3
 import logging
+import threading
 
+from queue import Queue, Empty, Full
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, timedelta as td
 
 from ext import setup_logger, args, config, now
 
-from mb import MBR
+from mb import MBR, MBError, CircuitOpen
+from cassette import Cassette
 
 from ical_builder import IcalBuilder as ICB
 from rss_builder import RSSBuilder as RSB
 from notifier import Notifier
+from dump_import import DumpImporter
+from batch_import import BatchImporter, normalize_name
+from scheduler import RefreshScheduler, Budget
 
 from db.db_handler import CONFLICT as CON, STATUS as STAT
 from db.music_db import MusicDB as MDB
+from db.sqlite_profile import load_profile
 
 setup_logger()
 
@@ -21,11 +34,14 @@ artists_path = 'parsed_artists.txt'
 
 is_refresh = config.getboolean('SETTINGS', 'a_refresh')
 refresh_time = config.get('SETTINGS', 'a_refresh_time')
+refresh_min = config.get('SETTINGS', 'a_refresh_min', fallback='12h')
+refresh_max = config.get('SETTINGS', 'a_refresh_max', fallback='30d')
 
 tg_id = config.get('SETTINGS', 'tg_id')
 tg_token = config.get('SETTINGS', 'tg_token')
 
 master_import_path = config.get('PATHS', 'artists')
+review_path = config.get('PATHS', 'review', fallback='review_artists.txt')
 
 d_past = config.getint('SETTINGS', 'd_past')
 d_fut = config.getint('SETTINGS', 'd_fut')
@@ -45,7 +61,7 @@ if not db_path:
     logger.error('No path for the database was specified')
     exit(1)
 
-db: MDB = MDB(db_path)
+db: MDB = MDB(db_path, load_profile(config))
 
 chosen_artists = []
 if args.pick_artists:
@@ -55,6 +71,36 @@ is_import = True if args.file else False
 
 ts_fmt = '%Y-%m-%d %H:%M:%S'
 
+batch_size = config.getint('MB', 'batch_size', fallback=25)
+queue_size = config.getint('SETTINGS', 'refresh_queue', fallback=4)
+import_batch = config.getint('MB', 'import_batch', fallback=10)
+
+worker_name = config.get('WORKER', 'name', fallback='') or socket.gethostname()
+shard = config.get('WORKER', 'shard', fallback='0/1')
+lease_ttl = config.getint('WORKER', 'lease_ttl', fallback=900)
+lease_batch = config.getint('WORKER', 'lease_batch', fallback=0)
+
+try:
+    shard_no, shard_count = [int(n) for n in shard.split('/')]
+    if not 0 <= shard_no < shard_count:
+        raise ValueError
+except ValueError:
+    logger.error(f"Invalid shard '{shard}', expected N/COUNT with 0 <= N < COUNT")
+    exit(1)
+
+'''
+The leases and the journal of the refresh runs belong to a single process,
+so processes of the same worker and shard (e.g. overlapping runs) never
+refresh the same artists, a process of the worker takes them over
+from the ones of the same host that are no longer running
+'''
+worker_id = worker_name if shard_count == 1 else f'{worker_name}/{shard}'
+lease_owner = f'{worker_id}:{socket.gethostname()}:{os.getpid()}'
+
+poll_min = config.getint('DAEMON', 'poll_min', fallback=60)
+poll_max = config.getint('DAEMON', 'poll_max', fallback=3600)
+poll_jitter = config.getint('DAEMON', 'jitter', fallback=300)
+
 def load_wanted_types(file_path: str) -> list[str]:
     '''
     Load the types of releases to notify about
@@ -97,9 +143,82 @@ def parse_refresh_time(conf_time: str) -> int:
             raise ValueError("Invalid character in refresh time: '" + c + "'")
     return t.get('d', 0) * 86400 + t.get('h', 0) * 3600 + t.get('m', 0) * 60
 
+def is_dead(owner: str) -> bool:
+    '''
+    Checks whether a lease token of this worker belongs to a process that is no longer running,
+    the processes of other hosts are never taken for dead, their leases expire instead
+
+    Parameters:
+        owner (str): The lease token (worker:host:pid)
+
+    Returns:
+        bool: True if the process is not running
+    '''
+    #tokens without a process were written before the leases belonged to one
+    if owner == worker_id:
+        return True
+
+    host, _, pid = owner[len(worker_id) + 1:].rpartition(':')
+    if host != socket.gethostname() or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        return False
+    return False
+
+def same_file(path: str, other: str) -> bool:
+    '''
+    Checks whether two paths point to the same file,
+    relative paths and symbolic links are resolved
+
+    Parameters:
+        path (str): The first path
+        other (str): The second path
+
+    Returns:
+        bool: True if both paths resolve to the same file
+    '''
+    return os.path.realpath(path) == os.path.realpath(other)
+
+def scan_artists(file_path: str) -> tuple[list[str], list[str], int | None]:
+    '''
+    Read an artists file in a single pass, skipping empty lines, comments and sections
+    The names before the [New] section are the ones already imported, a file
+    without the [New] section is a plain list of artists to import
+
+    Parameters:
+        file_path (str): The path to the file to read
+
+    Returns:
+        tuple: The names already imported, the names to import and the
+               position in bytes of the [New] section (None if missing)
+    '''
+    old_artists = []
+    new_artists = []
+    new_at = None
+    pos = 0
+
+    with open(file_path, 'rb') as file:
+        for raw in file:
+            line = raw.decode('utf-8').strip()
+            if line.lower() == '[new]' and new_at is None:
+                new_at = pos
+            elif line and not line.startswith(('[', '#')):
+                (old_artists if new_at is None else new_artists).append(line)
+            pos += len(raw)
+
+    if new_at is None:
+        return [], old_artists, None
+
+    return old_artists, new_artists, new_at
+
 def load_lines(file_path: str) -> tuple[list[str], int]:
     '''
-    Load the lines from a file and remove empty lines and sections
+    Load the lines from a file and remove empty lines, comments and sections
     If the file contains a section [New] the function will return the index of said section
 
     Parameters:
@@ -108,35 +227,26 @@ def load_lines(file_path: str) -> tuple[list[str], int]:
     Returns:
         tuple: The lines and the index of the new artists section
     '''
-    with open(file_path) as file:
-        lines = file.read().splitlines()
-    
-    new_artists = 0
-    i = 0
-
-    for line in lines:
-        if line.startswith('\n') or line.isspace() or line.startswith('['):
-            lines.pop(i)
-            if line.lower().strip() == '[new]':
-                new_artists = i
-        i += 1
+    old_artists, new_artists, _ = scan_artists(file_path)
+    return old_artists + new_artists, len(old_artists)
 
-    return lines, new_artists
 
-
-def handle_artist(artist_name: str, auto: bool = False) -> tuple[str, str, str]:
+def handle_artist(artist_name: str, auto: bool = False, 
+                  result: list | None = None) -> tuple[str, str, str]:
     '''
     Search for an artist in the MusicBrainz database and return its data
 
     Parameters:
         artist_name (str): The name of the artist to search for
         auto (bool): Whether to automatically choose the first result or not
+        result (list | None): The search results if they were already fetched
     
     Returns:
         tuple: The data of the artist found
     '''
     logger.info('Handling artist: ' + artist_name)
-    result = mb.search_artist(artist_name)
+    if result is None:
+        result = mb.search_artist(artist_name)
 
     if not result:
         return None
@@ -175,6 +285,23 @@ def handle_artist(artist_name: str, auto: bool = False) -> tuple[str, str, str]:
         logger.info('Found artist: ' + a['name'])
         return (a['id'], a['name'], a.get('disambiguation', None))
     
+def search_artist(artist_name: str) -> list | None:
+    '''
+    Search for an artist in the MusicBrainz database
+
+    Parameters:
+        artist_name (str): The name of the artist to search for
+
+    Returns:
+        list: The search results
+        None: If MusicBrainz could not be reached
+    '''
+    try:
+        return mb.search_artist(artist_name)
+    except MBError as e:
+        logger.error('Could not search artist ' + artist_name + ': ' + str(e))
+        return None
+
 def insert_artist(a_data: tuple[str, str, str]) -> str | None:
     '''
     Insert an artist into the database
@@ -198,7 +325,7 @@ def insert_artist(a_data: tuple[str, str, str]) -> str | None:
         return artist
     return None
 
-def import_artists(file_path: str, auto: bool = False):
+def import_artists(file_path: str, auto: bool = False, batch: bool = False):
     '''
     Import artists from a file and insert them into the database
     Adding the new artists to the master import file
@@ -206,41 +333,309 @@ def import_artists(file_path: str, auto: bool = False):
     Parameters:
         file_path (str): The path to the file containing the artists to import
         auto (bool): Whether to automatically choose the first result or not
+        batch (bool): Whether to resolve the artists without user input,
+                      writing the ambiguous ones to the review file
     '''
 
-    all_artists, new_i = load_lines(file_path)
+    old_artists, all_new, _ = scan_artists(file_path)
 
-    if new_i == len(all_artists):
+    if not all_new:
         logger.info('No new artists to import detected')
         return
     
-    logger.info('Found ' + str(new_i) + ' old artists and ' + str(len(all_artists) - new_i) + ' new artists')
+    logger.info('Found ' + str(len(old_artists)) + ' old artists and ' + str(len(all_new)) + ' new artists')
+
+    #the artists of another file are added to the master file as well
+    added = old_artists if not same_file(file_path, master_import_path) else []
+    new_artists = []
+
+    '''
+    Artists already in the database (e.g. loaded from a dump) are not searched again,
+    the batch import compares the names ignoring case, accents and punctuation,
+    the other imports only skip exact names, so a different artist
+    with a similar name is still searched and chosen by the user
+    '''
+    key = normalize_name if batch else str
+    known = {key(n) for (n,) in db.fetchall('artists', ['name'])}
+    for artist in dict.fromkeys(all_new):
+        if key(artist) in known:
+            logger.info('Artist already in the database: ' + artist)
+            added.append(artist)
+        else:
+            new_artists.append(artist)
 
-    old_artists = all_artists[:new_i]
-    new_artists = all_artists[new_i:]
+    if batch:
+        importer = BatchImporter(mb, review_path, import_batch)
+        found, ambiguous, missing, retry_artists = importer.resolve(new_artists)
 
-    for artist in new_artists:
-        a_data = handle_artist(artist, auto)
-        right_a = insert_artist(a_data)
-        if not right_a:
+        for artist in new_artists:
+            if artist in found:
+                added.append(insert_artist(found[artist]))
+        for artist in missing:
             logger.warning('Could not find artist: ' + artist)
+        importer.write_review(ambiguous)
+
+        sync_artists(file_path, added, retry_artists)
+        return
+
+    '''
+    The searches are fanned out over the workers allowed by the endpoint,
+    the results are consumed in order so the choices are still asked one at a time
+    '''
+    retry_artists = []
+
+    with ThreadPoolExecutor(max_workers=mb.workers) as pool:
+        results = pool.map(search_artist, new_artists)
+
+        for artist, result in zip(new_artists, results):
+            if result is None:
+                retry_artists.append(artist)
+                continue
+            a_data = handle_artist(artist, auto, result)
+            right_a = insert_artist(a_data)
+            if not right_a:
+                logger.warning('Could not find artist: ' + artist)
+            else:
+                added.append(right_a)
+
+    sync_artists(file_path, added, retry_artists)
+
+def sync_artists(file_path: str, added: list[str], retry: list[str]):
+    '''
+    Update the master import file in place, the file is cut at the [New]
+    section and only the artists added and the ones to retry are written,
+    so the cost does not depend on the number of artists already imported
+
+    Parameters:
+        file_path (str): The path to the file the artists were imported from
+        added (list): The artists added to the database
+        retry (list): The artists to search again on the next run
+    '''
+    old_artists, pending, new_at = [], [], None
+    if os.path.exists(master_import_path):
+        old_artists, pending, new_at = scan_artists(master_import_path)
+
+    '''
+    The artists still waiting in the master file are kept when another file
+    was imported, when the master file itself was imported they were just handled
+    '''
+    if not same_file(file_path, master_import_path):
+        retry = pending + retry
+    seen = set(old_artists)
+    added = [a for a in dict.fromkeys(added) if a not in seen]
+    retry = [a for a in dict.fromkeys(retry) if a not in seen]
+
+    if new_at is None:
+        with open(master_import_path, 'w') as file:
+            file.write('[Added]\n')
+            for line in old_artists + added:
+                file.write(line + '\n')
+            file.write('[New]\n')
+            for line in retry:
+                file.write(line + '\n')
+        return
+
+    with open(master_import_path, 'r+b') as file:
+        file.seek(new_at)
+        file.truncate()
+        lines = added + ['[New]'] + retry
+        file.write(('\n'.join(lines) + '\n').encode('utf-8'))
+
+def fetch_release_groups(mbids: list[str], since: str, offset: int = 0):
+    '''
+    Fetch the release groups of one or more artists first released on or after a date,
+    one page at a time, starting from the given offset
+
+    In search mode the date filter is applied by MusicBrainz and every artist
+    of the batch is queried at once, the results are then split back per artist
+    using their artist credits. In browse mode a single artist is expected and
+    every release group is downloaded and filtered here
+
+    Parameters:
+        mbids (list): The MusicBrainz IDs of the artists
+        since (str): The minimum first release date (YYYY-MM-DD)
+        offset (int): The offset of the first page to fetch
+
+    Returns:
+        generator: For each page, the release groups of each artist MBID, the offset
+                   of the next page, whether it was the last page and the total number
+                   of release groups of the artist (None in search mode or before the last page)
+    '''
+    LIMIT = 100
+
+    while True:
+        releases = {mbid: [] for mbid in mbids}
+
+        if mb.rg_mode == 'search':
+            rl, count = mb.search_release_groups(mbids, since, LIMIT, offset)
+            for r in rl:
+                if r.get('first-release-date', '') < since:
+                    continue
+                for credit in r.get('artist-credit', []):
+                    a_mbid = credit.get('artist', {}).get('id')
+                    if a_mbid in releases and r not in releases[a_mbid]:
+                        releases[a_mbid].append(r)
+            offset += LIMIT
+            done = offset >= count
+            yield releases, offset, done, None
+        else:
+            mbid = mbids[0]
+            rl = mb.get_release_group(mbid, LIMIT, offset)
+            releases[mbid] += [r for r in rl if r['first-release-date'] >= since]
+            done = len(rl) < LIMIT
+            yield releases, offset + LIMIT, done, offset + len(rl) if done else None
+            offset += LIMIT
+
+        if done:
+            return
+
+def forward(out: Queue, item, stop: threading.Event) -> bool:
+    '''
+    Puts an item on the queue feeding the writer, waiting for room
+    only as long as the writer is still reading it
+
+    Parameters:
+        out (Queue): The queue feeding the writer
+        item: The item to put
+        stop (threading.Event): Set when the writer stopped
+
+    Returns:
+        bool: False if the writer stopped before the item was put
+    '''
+    while not stop.is_set():
+        try:
+            out.put(item, timeout=1)
+            return True
+        except Full:
+            continue
+    return False
+
+def fetch_batches(batches: Queue, since: str, out: Queue, stop: threading.Event,
+                  budget: Budget | None = None):
+    '''
+    Producer of the refresh pipeline, it fetches the release groups of each
+    batch of artists and hands them to the writer page by page through a
+    bounded queue, so the rate limiter is kept busy while the database is written
+
+    Several producers can share the same batches queue when the endpoint
+    allows concurrent requests, each one puts a None item on the output
+    queue when no batches are left, an exception is forwarded to the
+    writer to be raised there
+
+    A batch that cannot be fetched is skipped so its artists are not marked
+    as refreshed, if the circuit breaker gives up or the budget is spent
+    no more batches are fetched, if the writer stops the producers stop too
+
+    Parameters:
+        batches (Queue): The batches of artists to fetch (number, artists, page offset)
+        since (str): The minimum first release date (YYYY-MM-DD)
+        out (Queue): The queue feeding the writer
+        stop (threading.Event): Set when the writer stopped
+        budget (Budget | None): The limit on the requests or time of the run
+    '''
+    try:
+        while not stop.is_set():
+            if budget and budget.exhausted():
+                logger.info('Refresh budget spent, the remaining artists will be refreshed on the next run')
+                break
+            try:
+                b_no, batch, offset = batches.get_nowait()
+            except Empty:
+                break
+            logger.info('Getting releases for ' + ', '.join([a[2] for a in batch]))
+            try:
+                for page in fetch_release_groups([a[1] for a in batch], since, offset):
+                    if not forward(out, (b_no, batch, *page), stop):
+                        return
+            except CircuitOpen as e:
+                logger.error(str(e) + ', the remaining artists will be refreshed on the next run')
+                break
+            except MBError as e:
+                logger.error('Skipping ' + ', '.join([a[2] for a in batch]) + ': ' + str(e))
+    except Exception as e:
+        forward(out, e, stop)
+        return
+    forward(out, None, stop)
+
+def store_releases(a_id: int, releases: list, diff: dict):
+    '''
+    Insert or update the release groups of an artist and their secondary types,
+    every row is written in bulk and committed by the caller, the types and the
+    existing releases are resolved from the caches of the database object
+
+    Releases whose fingerprint did not change since the last refresh are not
+    written, so their last update time is preserved
+
+    Parameters:
+        a_id (int): The ID of the artist
+        releases (list): The release groups of the artist
+        diff (dict): The counts of inserted, changed and unchanged releases to update
+    '''
+    rows = []
+    st_ids = []
+    ts = now(ts_fmt)
+
+    for r in releases:
+        pt = r.get('primary-type') or 'Other'
+        tid = db.get_type_id(pt)
+
+        if not tid:
+            tid = db.insert('types',
+                            columns=('name',),
+                            values=(pt,))
+
+        st = [db.get_type_id(t) for t in r.get('secondary-types', [])]
+        st = [t for t in st if t]
+        st_ids.append(st)
+
+        fp = db.release_fingerprint(r['title'], r['first-release-date'], tid, st)
+        rows.append((r['id'], a_id, r['title'], r['first-release-date'], ts, tid, fp))
+
+    stored = db.upsert_releases(rows, commit=False)
+
+    types = []
+    changed = []
+    for r, st, (rid, stat) in zip(releases, st_ids, stored):
+        if stat == STAT.UNCHANGED:
+            diff['unchanged'] += 1
+            continue
+
+        if stat == STAT.INSERT:
+            diff['inserted'] += 1
+            logger.info('Added release: ' + r['title'])
         else:
-            old_artists.insert(0, right_a)
+            diff['changed'] += 1
+            changed.append(rid)
+            logger.info('Updated release: ' + r['title'])
 
-    with open(master_import_path, 'w') as file:
-        file.write('[Added]\n')
-        for line in old_artists:
-            file.write(line + '\n')
-        file.write('[New]\n')
+        types += [(stid, rid) for stid in st]
 
-def get_new_releases(force, a_ref, arts):
+    if changed:
+        db.delete('types_releases', 
+                  'release_id IN (' + ', '.join(['?' for _ in changed]) + ')',
+                  changed, commit=False)
+
+    db.insert_many('types_releases', rows=types, 
+                   conflict=CON.IGNORE, commit=False)
+
+def get_new_releases(force, a_ref, arts, budget: Budget | None = None,
+                     bounds: tuple[int, int] = (0, 0)) -> dict:
     '''
-    Get new releases for each artist in the database
+    Get new releases for each artist in the database,
+    the artists are refreshed in order of expected value
+
+    Each artist is refreshed again after its own interval, derived from
+    its release history, a_ref is used for artists without one
 
     Parameters:
         force (bool): Whether to force the refresh of all artists
         a_ref (int): The minimum time in seconds to refresh an artist
         arts (list): The list of artists to refresh
+        budget (Budget | None): The limit on the requests or time of the run
+        bounds (tuple): The shortest and longest refresh interval of an artist in seconds
+
+    Returns:
+        dict: The number of releases inserted, changed and left unchanged by the run
     '''
 
     '''
@@ -250,6 +645,8 @@ def get_new_releases(force, a_ref, arts):
     If a_ref is set, refresh only the artists that need to be refreshed - Low priority
     If none of the above are set, do not refresh any artist
     '''
+    diff = {'inserted': 0, 'changed': 0, 'unchanged': 0}
+
     if force:
         logger.info('Forcing refresh of all artists')
         wheres = []
@@ -259,83 +656,332 @@ def get_new_releases(force, a_ref, arts):
                    'params': tuple(arts)}]
     elif a_ref > 0:
         logger.info('Getting artists that need to be refreshed')
-        wheres=[{'condition': """last_updated ISNULL OR 
-                                 last_updated + ? < ?""",
+        wheres=[{'condition': """(last_updated ISNULL OR 
+                                  last_updated + COALESCE(refresh_interval, ?) < ?)""",
                  'params': (a_ref, int(now('%s')))}]
     else:
         logger.info('No artists will be refreshed')
-        return
+        return diff
+
+    if shard_count > 1 and not arts:
+        wheres.append({'condition': 'id % ? = ?',
+                       'params': (shard_count, shard_no)})
     
-    artists = db.fetchall('artists', ['id', 'mbid', 'name'], 
-                          wheres=wheres,
-                          order_by={'columns': ('last_updated',), 
-                                    'order': 'DESC'})
+    a_cols = ['id', 'mbid', 'name', 'rg_count', 'refresh_interval', 'last_updated']
+    scheduler = RefreshScheduler(db, a_ref, *bounds)
+    batches = Queue()
+
+    '''
+    A run interrupted before its end is resumed first, from the page
+    each batch of artists reached, an explicit selection (-p or -f) is
+    refreshed once the resumed run is finished, the leases and runs
+    of the processes of this worker no longer running are taken over
+    in the same transaction, so only one process can take them
+    '''
+    with db.transaction():
+        db.take_over_leases(lease_owner, [o for o in db.get_lease_owners(worker_id) if is_dead(o)])
+        run_id, pending = db.get_unfinished_refresh(lease_owner)
+    resumed = run_id is not None
+
+    '''
+    Only the artists leased by this process are refreshed, the ones
+    leased by other workers are left to them
+    '''
+    skipped = 0
+    if run_id:
+        logger.info(f'Resuming interrupted refresh run {run_id}, {len(pending)} batches left')
+        for b_no, (a_ids, offset) in pending.items():
+            a_ids = db.claim_artists(lease_owner, a_ids, lease_ttl)
+            if not a_ids:
+                skipped += 1
+                continue
+            batch = db.fetchall('artists', a_cols,
+                                wheres=[{'condition': 'id IN (' + ', '.join(['?' for _ in a_ids]) + ')',
+                                         'params': tuple(a_ids)}])
+            batches.put((b_no, batch, offset))
+    else:
+        artists = db.fetchall('artists', a_cols, wheres=wheres)
+        artists = scheduler.rank(artists)
+        if lease_batch:
+            artists = artists[:lease_batch]
+
+        claimed = set(db.claim_artists(lease_owner, [a[0] for a in artists], lease_ttl, wheres))
+        if len(claimed) < len(artists):
+            logger.info(f'{len(artists) - len(claimed)} artists are leased by other workers')
+        artists = [a for a in artists if a[0] in claimed]
+
+        logger.info('Found ' + str(len(artists)) + ' artists to refresh')
+
+        b_size = batch_size if mb.rg_mode == 'search' else 1
+        b_list = [artists[i:i + b_size] for i in range(0, len(artists), b_size)]
+
+        #a run without artists is not journaled, there is nothing to resume
+        if b_list:
+            run_id = db.start_refresh([[a[0] for a in batch] for batch in b_list], lease_owner)
+        for b_no, batch in enumerate(b_list):
+            batches.put((b_no, batch, 0))
+
+    since = (date.today() - td(days=30)).isoformat()
+    saved_total = 0
+    #the release groups of each artist found in the date window, to report the pages saved
+    seen = {}
+
+    pipe = Queue(maxsize=max(queue_size, mb.workers))
+    stop = threading.Event()
+    fetchers = [threading.Thread(target=fetch_batches, 
+                                 args=(batches, since, pipe, stop, budget), 
+                                 daemon=True) 
+                for _ in range(mb.workers)]
+    for fetcher in fetchers:
+        fetcher.start()
+
+    #the producers stop as well if the writer raises, instead of waiting on the full pipe forever
+    try:
+        running = len(fetchers)
+        while running:
+            item = pipe.get()
+            if item is None:
+                running -= 1
+                continue
+            if isinstance(item, Exception):
+                raise item
+
+            b_no, batch, releases, offset, done, total = item
+            for a in batch:
+                seen[a[0]] = seen.get(a[0], 0) + len(releases[a[1]])
+
+            '''
+            Each page is written in a single transaction together with its checkpoint,
+            the releases of each artist in a savepoint, an artist whose releases
+            could not be written is rolled back alone and left to the next run
+            '''
+            with db.transaction():
+                failed = set()
+                for a in batch:
+                    try:
+                        with db.transaction():
+                            store_releases(a[0], releases[a[1]], diff)
+                    except sqlite3.Error as e:
+                        logger.error(f'Could not store the releases of {a[2]}: {e}')
+                        failed.add(a[0])
+
+                db.renew_leases(lease_owner, lease_ttl)
+
+                if not done:
+                    db.checkpoint_refresh(run_id, b_no, offset)
+                    continue
+
+                '''
+                Browsing an artist takes a page for every 100 of its release groups,
+                rg_count only holds the totals of the browse mode, so an artist never
+                browsed is counted with the pages of its date filtered search alone
+                '''
+                pages = -(-offset // 100)
+                if total is None:
+                    alone = 0
+                    for id, _, name, rg_count, _, _ in batch:
+                        filtered = max(-(-seen.get(id, 0) // 100), 1)
+                        if rg_count is None:
+                            alone += filtered
+                            continue
+                        browsed = max(-(-rg_count // 100), 1)
+                        alone += browsed
+                        logger.info(f'{name}: {browsed - filtered} page(s) saved by the date filter')
+
+                    saved = max(alone - pages, 0)
+                    saved_total += saved
+                    logger.info(f'Fetched {pages} page(s) for {len(batch)} artist(s) '
+                                f'instead of {alone}, {saved} page(s) saved')
+
+                for a in batch:
+                    seen.pop(a[0], None)
+
+                activity = db.get_artist_activity([a[0] for a in batch])
+                db.checkpoint_refresh(run_id, b_no, offset, done=True)
+
+                stamps = []
+                for id, mbid, name, rg_count, _, _ in batch:
+                    if id in failed:
+                        continue
+                    interval = scheduler.interval(*activity.get(id, (0, 0, None)))
+                    logger.debug(f'Next refresh of {name} in {interval}s')
+                    stamps.append((now('%s'), total if total is not None else rg_count, 
+                                   interval, None, None, id))
+
+                db.update_many('artists', 
+                               columns=('last_updated', 'rg_count', 'refresh_interval', 
+                                        'lease_owner', 'lease_expires'),
+                               rows=stamps,
+                               key_columns=('id',))
+    finally:
+        stop.set()
+
+    for fetcher in fetchers:
+        fetcher.join()
+
+    db.release_leases(lease_owner)
+
+    finished = not skipped and batches.empty()
+    if skipped:
+        logger.info(f'{skipped} batches of refresh run {run_id} are leased by other workers, '
+                    'the run will be resumed by the next run')
+    elif finished:
+        if run_id:
+            db.finish_refresh(run_id)
+    else:
+        logger.info(f'Refresh run {run_id} stopped early, it will be resumed by the next run')
+
+    if saved_total:
+        logger.info(f'Date filtering and batching saved {saved_total} page request(s)')
+
+    logger.info(f"Releases inserted: {diff['inserted']}, "
+                f"changed: {diff['changed']}, "
+                f"unchanged: {diff['unchanged']}")
+
+    if resumed and (force or arts):
+        if finished and not (budget and budget.exhausted()):
+            logger.info('Resumed run finished, getting releases for the requested artists')
+            for k, v in get_new_releases(force, a_ref, arts, budget, bounds).items():
+                diff[k] += v
+        else:
+            logger.warning('The requested artists were not refreshed, '
+                           'the interrupted run has to be finished first')
+    return diff
+
+def build_outputs(keep_rt: list[str]):
+    '''
+    Build the output files chosen with the -t option
+
+    Parameters:
+        keep_rt (list): The types of releases to add to the files
+    '''
+    if args.type == 'ics' or args.type == 'all':
+        builder = ICB(db, 'templates/event.ics')
+        builder.build_ical(keep_rt)
+        for path in ics_path:
+            builder.save(path)
+            
     
-    logger.info('Found ' + str(len(artists)) + ' artists to refresh')
+    if args.type == 'rss' or args.type == 'all':
+        builder = RSB(db)
+        builder.build_feed(keep_rt, d_past, d_fut)
+        for path in rss_path:
+            builder.save(path)
 
-    for id, mbid, name in artists:
+def send_notifications(keep_rt: list[str]):
+    '''
+    Notify the releases to telegram if the -n option was specified
 
-        logger.info('Getting releases for ' + name)
+    Parameters:
+        keep_rt (list): The types of releases to notify about
+    '''
+    if not args.notify:
+        return
 
-        offset = 0
-        releases = []
-        today = date.today() - td(days=30)
+    if not tg_id:
+        logger.error('No Telegram ID was provided, notifications will not be sent')
+    elif not tg_token:
+        logger.error('No Telegram token was provided, notifications will not be sent')
+    else:
+        notifier = Notifier(db, tg_id, tg_token, n_days)
+        notifier.notify(keep_rt)
 
-        while True:
-            LIMIT = 100
-            rl = mb.get_release_group(mbid, LIMIT, offset)
-            releases += [r for r in rl if r['first-release-date'] >= today.isoformat()]
-            if len(rl) < LIMIT:
-                break
-            offset += LIMIT
+def run_daemon(import_path: str, a_ref: int, bounds: tuple[int, int]):
+    '''
+    Keep refreshing the artists as they become due, until SIGINT or SIGTERM
 
-        for r in releases:
-            pt = r['primary-type']
-            rmbid = r['id']
-            st = r.get('secondary-types', [])
-            rd = r['first-release-date']
-            tit = r['title']
-            tid = db.get_type_id(pt)
-
-            if not tid:
-                tid = db.insert('types',
-                                columns=('name',),
-                                values=(pt,))
-
-            rid, stat = db.insert_update('releases',
-                            columns=('mbid', 'artist_mbid', 'title',
-                                     'release_date', 'last_updated',
-                                     'primary_type'),
-                            values=(rmbid, id, tit, rd, now(ts_fmt), tid),
-                            conflict_columns=('mbid',))
-
-            if stat == STAT.INSERT:
-                logger.info('Added release: ' + tit)
-            else:
-                logger.info('Release already in the database: ' + tit)
+    A cycle that fails is logged and its leases given back, its unfinished
+    refresh run is resumed by the next cycle
 
-            for type in st:
-                stid = db.get_type_id(type)
+    The MusicBrainz session, the database connection and their caches stay open
+    between cycles, the outputs are rebuilt and the notifications sent only when
+    a cycle changed the releases, when the day changes (the feeds and reminders
+    depend on the date) or when the artists file was edited
 
-                if stid:
-                    db.insert('types_releases', values=(stid, rid),
-                              conflict=CON.IGNORE)
-        
-        db.update('artists', 
-                  columns=('last_updated',),
-                  values=(now('%s'),), 
-                  condition=[{'condition': 'id = ?', 
-                              'params': (id,)}])
+    Parameters:
+        import_path (str): The path to the artists file, imported again when it changes
+        a_ref (int): The refresh interval in seconds of artists without their own
+        bounds (tuple): The shortest and longest refresh interval of an artist in seconds
+    '''
+    stop = threading.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stop.set())
+
+    keep_rt = load_wanted_types('release_types.conf')
+    a_mtime = os.path.getmtime(import_path)
+    day = None
+
+    logger.info(f'Daemon started, polling every {poll_min}-{poll_max}s with up to {poll_jitter}s of jitter')
+
+    while not stop.is_set():
+        try:
+            edited = os.path.getmtime(import_path) != a_mtime
+            if edited:
+                logger.info('The artists file changed, importing it again')
+                import_artists(import_path, batch=True)
+                a_mtime = os.path.getmtime(import_path)
+
+            budget = None
+            if args.budget:
+                try:
+                    budget = Budget(args.budget, mb)
+                except ValueError as e:
+                    logger.error(str(e) + ', the refresh will not be limited')
+
+            diff = get_new_releases(force=False, a_ref=a_ref, arts=[], 
+                                    budget=budget, bounds=bounds)
+
+            if diff['inserted'] or diff['changed'] or edited or day != date.today():
+                day = date.today()
+                build_outputs(keep_rt)
+                send_notifications(keep_rt)
+            else:
+                logger.info('No releases changed, the outputs were not rebuilt')
+        except Exception as e:
+            logger.error(f'Refresh cycle failed: {e!r}, retrying on the next cycle')
+            try:
+                db.release_leases(lease_owner)
+            except sqlite3.Error as e:
+                logger.error(f'Could not release the leases: {e}, they will expire')
+
+        '''
+        Sleep until the next artist is due, the jitter spreads the requests
+        of several instances and avoids hitting the endpoint on the minute
+        '''
+        try:
+            due = db.get_next_refresh(a_ref)
+        except sqlite3.Error as e:
+            logger.error(f'Could not get the next refresh time: {e}, retrying soon')
+            due = 0
+        wait = poll_max if due is None else due - int(now('%s'))
+        wait = min(max(wait, poll_min), poll_max) + random.uniform(0, poll_jitter)
+        logger.info(f'Next cycle in {int(wait)}s')
+        stop.wait(wait)
+
+    logger.info('Daemon stopped')
 
 if __name__ == '__main__':
-    mb = MBR()
+    cassette = None
+    if args.record:
+        cassette = Cassette(args.record, 'record')
+    elif args.replay:
+        cassette = Cassette(args.replay, 'replay', args.replay_latency)
+
+    mb = MBR(cassette)
 
     '''
     If the user wants to add artists from a custom file path it can do so by specifying the -i option followed by the file path
     Otherwise the master import path will be chosen
     '''
     import_path = args.file if is_import else master_import_path
-    import_artists(import_path, args.auto)
+
+    if args.dump:
+        wanted, _ = load_lines(import_path)
+        DumpImporter(db).load(args.dump, wanted, 
+                              (date.today() - td(days=30)).isoformat(),
+                              args.dump_time)
+
+    import_artists(import_path, args.auto, args.batch or args.daemon)
 
     if is_refresh:
         try:
@@ -347,30 +993,33 @@ if __name__ == '__main__':
     else:
         refresh_time = -1
 
-    get_new_releases(force=args.refresh, a_ref=refresh_time, arts=chosen_artists)
-
-    keep_rt = load_wanted_types('release_types.conf')
+    try:
+        refresh_bounds = (parse_refresh_time(refresh_min), parse_refresh_time(refresh_max))
+    except ValueError as e:
+        logger.error(str(e) + ', every artist will use the global refresh time')
+        refresh_bounds = (refresh_time, refresh_time)
 
-    if args.type == 'ics' or args.type == 'all':
-        builder = ICB(db, 'templates/event.ics')
-        builder.build_ical(keep_rt)
-        for path in ics_path:
-            builder.save(path)
-            
-    
-    if args.type == 'rss' or args.type == 'all':
-        builder = RSB(db)
-        builder.build_feed(keep_rt, d_past, d_fut)
-        for path in rss_path:
-            builder.save(path)
+    budget = None
+    if args.budget:
+        try:
+            budget = Budget(args.budget, mb)
+        except ValueError as e:
+            logger.error(str(e) + ', the refresh will not be limited')
 
-    if args.notify:
-        if not tg_id:
-            logger.error('No Telegram ID was provided, notifications will not be sent')
-        elif not tg_token:
-            logger.error('No Telegram token was provided, notifications will not be sent')
+    if args.daemon:
+        if refresh_time <= 0:
+            logger.error('The daemon needs a_refresh enabled with a valid a_refresh_time')
         else:
-            notifier = Notifier(db, tg_id, tg_token, n_days)
-            notifier.notify(keep_rt)
+            run_daemon(import_path, refresh_time, refresh_bounds)
+    else:
+        diff = get_new_releases(force=args.refresh, a_ref=refresh_time, 
+                                arts=chosen_artists, budget=budget,
+                                bounds=refresh_bounds)
+
+        keep_rt = load_wanted_types('release_types.conf')
+
+        build_outputs(keep_rt)
+        send_notifications(keep_rt)
 
+    mb.close()
     db.close()
\ No newline at end of file
@@ -0,0 +1,207 @@
+import os
+import logging
+import unicodedata
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ext import now
+from mb import MBR, MBError
+
+logger = logging.getLogger(__name__)
+
+def normalize_name(name: str) -> str:
+    '''
+    Normalizes an artist name so that different spellings of it match,
+    case, accents, punctuation and a leading "The" are ignored
+
+    Parameters:
+        name (str): The name of the artist
+
+    Returns:
+        str: The normalized name
+    '''
+    n_name = unicodedata.normalize('NFKD', name)
+    n_name = ''.join([c for c in n_name if not unicodedata.combining(c)])
+    n_name = ''.join([c if c.isalnum() else ' ' for c in n_name.casefold()])
+
+    words = n_name.split()
+    if len(words) > 1 and words[0] == 'the':
+        words = words[1:]
+
+    #names made only of symbols (e.g. !!!) are kept as they are
+    return ' '.join(words) or name.casefold().strip()
+
+class BatchImporter:
+    '''
+    Class to resolve many artist names on MusicBrainz without user input
+
+    The names are searched several at a time with a single request, the
+    results are split back to each name by normalized name or alias,
+    the names left unmatched are searched one by one and the ones that
+    still have more than one candidate are written to a review file
+
+    Attributes:
+        __mb (MBR): The MusicBrainz client
+        __batch_size (int): The number of names searched with a single request
+        __review_path (str): The file the ambiguous artists are written to
+    '''
+
+    def __init__(self, mb: MBR, review_path: str, batch_size: int = 10):
+        self.__mb = mb
+        self.__batch_size = max(batch_size, 1)
+        self.__review_path = review_path
+
+    def resolve(self, names: list[str]) -> tuple[dict, dict, list, list]:
+        '''
+        Resolves the names to MusicBrainz artists, the searches are fanned
+        out over the workers allowed by the endpoint
+
+        Parameters:
+            names (list): The names of the artists
+
+        Returns:
+            tuple: The data of each artist found (mbid, name, disambiguation),
+                   the candidates of each ambiguous name, the names not found
+                   and the names that could not be searched
+        '''
+        found = {}
+        ambiguous = {}
+        missing = []
+        failed = []
+        single = []
+
+        chunks = [names[i:i + self.__batch_size]
+                  for i in range(0, len(names), self.__batch_size)]
+
+        with ThreadPoolExecutor(max_workers=self.__mb.workers) as pool:
+            for chunk, result in zip(chunks, pool.map(self.__search_many, chunks)):
+                if result is None:
+                    failed += chunk
+                    continue
+                for name in chunk:
+                    cands = self.__candidates(name, result)
+                    if len(cands) == 1:
+                        found[name] = self.__data(cands[0])
+                    elif cands:
+                        ambiguous[name] = cands
+                    else:
+                        single.append(name)
+
+            for name, result in zip(single, pool.map(self.__search_one, single)):
+                if result is None:
+                    failed.append(name)
+                elif not result:
+                    missing.append(name)
+                elif self.__is_sure(result):
+                    found[name] = self.__data(result[0])
+                else:
+                    ambiguous[name] = result
+
+        logger.info(f'Resolved {len(found)} artists, {len(ambiguous)} ambiguous, '
+                    f'{len(missing)} not found, {len(failed)} to retry')
+        return found, ambiguous, missing, failed
+
+    def write_review(self, ambiguous: dict):
+        '''
+        Appends the ambiguous artists and their candidates to the review file,
+        the file can be imported with -f to choose the right artists
+
+        Parameters:
+            ambiguous (dict): The candidates of each ambiguous name
+        '''
+        if not ambiguous:
+            return
+
+        is_new = not os.path.exists(self.__review_path) or not os.path.getsize(self.__review_path)
+
+        with open(self.__review_path, 'a') as file:
+            if is_new:
+                file.write('[New]\n')
+            file.write(f"# {now('%Y-%m-%d %H:%M:%S')}\n")
+            for name, cands in ambiguous.items():
+                file.write(name + '\n')
+                for c in cands:
+                    dis = c.get('disambiguation', '')
+                    file.write(f"#   {c['id']} {c['name']}" + (f' ({dis})' if dis else '') + '\n')
+
+        logger.warning(f'{len(ambiguous)} ambiguous artists were written to {self.__review_path}')
+
+    def __search_many(self, names: list[str]) -> list | None:
+        '''
+        Searches several names with a single request
+
+        Parameters:
+            names (list): The names of the artists
+
+        Returns:
+            list | None: The search results, None if MusicBrainz could not be reached
+        '''
+        try:
+            return self.__mb.search_artists(names)
+        except MBError as e:
+            logger.error('Could not search artists ' + ', '.join(names) + ': ' + str(e))
+            return None
+
+    def __search_one(self, name: str) -> list | None:
+        '''
+        Searches a single name
+
+        Parameters:
+            name (str): The name of the artist
+
+        Returns:
+            list | None: The search results, None if MusicBrainz could not be reached
+        '''
+        try:
+            return self.__mb.search_artist(name)
+        except MBError as e:
+            logger.error('Could not search artist ' + name + ': ' + str(e))
+            return None
+
+    def __candidates(self, name: str, result: list) -> list:
+        '''
+        Gets the results matching a name, the ones matching
+        by name are preferred to the ones matching by alias
+
+        Parameters:
+            name (str): The name of the artist
+            result (list): The results of the search
+
+        Returns:
+            list: The matching results
+        '''
+        n_name = normalize_name(name)
+
+        by_name = [r for r in result if normalize_name(r['name']) == n_name]
+        if by_name:
+            return by_name
+
+        return [r for r in result
+                if n_name in [normalize_name(a['name']) for a in r.get('aliases', [])]]
+
+    def __is_sure(self, result: list) -> bool:
+        '''
+        Checks whether the first result of a single search can be taken without asking
+
+        Parameters:
+            result (list): The results of the search
+
+        Returns:
+            bool: True if the first result is a perfect match and the only one
+        '''
+        if result[0]['score'] not in (100, 99):
+            return False
+        return len(result) == 1 or result[1]['score'] < result[0]['score']
+
+    def __data(self, artist: dict) -> tuple[str, str, str]:
+        '''
+        Gets the data of an artist to insert
+
+        Parameters:
+            artist (dict): The artist found
+
+        Returns:
+            tuple: The MBID, name and disambiguation of the artist
+        '''
+        logger.info('Found artist: ' + artist['name'])
+        return (artist['id'], artist['name'], artist.get('disambiguation', None))
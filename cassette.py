@@ -0,0 +1,187 @@
+import re
+import gzip
+import json
+import time
+import logging
+import threading
+
+from collections import deque
+from urllib.parse import urlencode, parse_qsl
+
+logger = logging.getLogger(__name__)
+
+'''
+The date filter of a release group search depends on the day of the run, it is
+left out of the key and the artists searched together are sorted, so a cassette
+keeps matching on another day. The set of artists of each search is still part
+of the key, a replay only matches if the due artists are batched the same way
+(same artists, batch_size and ranking), otherwise the requests miss the cassette
+'''
+SINCE = re.compile(r'firstreleasedate:\[[0-9-]+ TO')
+ARIDS = re.compile(r'arid:[0-9a-f-]+(?: OR arid:[0-9a-f-]+)*')
+
+class CassetteMiss(KeyError):
+    '''
+    Raised when a replayed request was never recorded
+    '''
+
+class CassetteResponse:
+    '''
+    Minimal stand-in for a requests.Response served from a cassette
+
+    Attributes:
+        url (str): The url of the recorded request
+        status_code (int): The recorded status code
+        headers (dict): The recorded headers
+        text (str): The recorded body
+    '''
+
+    def __init__(self, url: str, status_code: int, headers: dict, text: str):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.text = text
+
+    def json(self) -> dict:
+        return json.loads(self.text)
+
+class Cassette:
+    '''
+    Class to record the MusicBrainz traffic to a gzip compressed file
+    and to serve it back later, so runs can be profiled and compared offline
+
+    Every line of the cassette is a JSON object holding the request key,
+    the url, the status code, the Retry-After header, the body and the
+    time the request took. Requests repeated during a run are replayed
+    in the order they were recorded
+
+    Attributes:
+        __path (str): The path of the cassette file
+        __mode (str): 'record' or 'replay'
+        __latency (float | str | None): The simulated latency of a replayed request,
+                                        'recorded' to reuse the recorded one
+        __entries (dict): The recorded responses of each request key (replay)
+        __file (file): The cassette being written (record)
+        __lock (threading.Lock): Serializes concurrent workers
+    '''
+
+    def __init__(self, path: str, mode: str, latency: float | str | None = None):
+        if mode not in ('record', 'replay'):
+            raise ValueError('Invalid cassette mode: ' + mode)
+
+        self.__path = path
+        self.__mode = mode
+        self.__latency = latency
+        self.__entries = {}
+        self.__file = None
+        self.__lock = threading.Lock()
+
+        if mode == 'record':
+            self.__file = gzip.open(path, 'wt', encoding='utf-8')
+        else:
+            self.__load()
+
+    @property
+    def replaying(self) -> bool:
+        return self.__mode == 'replay'
+
+    def key(self, verb: str, params: dict) -> str:
+        '''
+        Builds the key of a request, the parameters and the artists
+        of a search are sorted and the date filter is left out,
+        so the same query always maps to the same entry
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+
+        Returns:
+            str: The request key
+        '''
+
+        params = dict(params)
+        if 'query' in params:
+            query = SINCE.sub('firstreleasedate:[* TO', str(params['query']))
+            params['query'] = ARIDS.sub(lambda m: ' OR '.join(sorted(m.group(0).split(' OR '))), query)
+
+        return verb + '?' + urlencode(sorted(params.items()))
+
+    def record(self, verb: str, params: dict, response, elapsed: float):
+        '''
+        Appends a response to the cassette
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+            response (requests.Response): The response received
+            elapsed (float): The seconds the request took
+        '''
+
+        entry = {'key': self.key(verb, params),
+                 'url': response.url,
+                 'status': response.status_code,
+                 'retry_after': response.headers.get('Retry-After'),
+                 'body': response.text,
+                 'elapsed': round(elapsed, 4)}
+
+        with self.__lock:
+            self.__file.write(json.dumps(entry) + '\n')
+
+    def replay(self, verb: str, params: dict, url: str) -> CassetteResponse:
+        '''
+        Serves the next recorded response of a request,
+        the last one is served again once they are exhausted
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+            url (str): The url of the request
+
+        Returns:
+            CassetteResponse: The recorded response
+
+        Raises:
+            CassetteMiss: If the request was never recorded
+        '''
+
+        key = self.key(verb, params)
+
+        with self.__lock:
+            recorded = self.__entries.get(key)
+            if not recorded:
+                raise CassetteMiss(key)
+            entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+
+        if self.__latency == 'recorded':
+            time.sleep(entry['elapsed'])
+        elif self.__latency:
+            time.sleep(float(self.__latency))
+
+        headers = {'Retry-After': entry['retry_after']} if entry['retry_after'] else {}
+        return CassetteResponse(entry['url'], entry['status'], headers, entry['body'])
+
+    def close(self):
+        '''
+        Close the cassette file
+        '''
+
+        if self.__file:
+            self.__file.close()
+            logger.info('Cassette saved: ' + self.__path)
+
+    def __load(self):
+        '''
+        Loads every recorded response, grouped by request key,
+        the keys are built again so older cassettes match as well
+        '''
+
+        n = 0
+        with gzip.open(self.__path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                entry = json.loads(line)
+                verb, _, qs = entry['key'].partition('?')
+                key = self.key(verb, dict(parse_qsl(qs)))
+                self.__entries.setdefault(key, deque()).append(entry)
+                n += 1
+
+        logger.info(f'Loaded {n} responses from cassette {self.__path}')
@@ -1,8 +1,13 @@
-import sqlite3
+import os
 import logging
+import threading
+
+from contextlib import contextmanager
 
 from db.query_builder import SelectQuery as Sel
 from db.query_builder import UpdateQuery as Upd
+from db.query_builder import QueryCache, CompiledQuery
+from db.sqlite_profile import connect
 
 logger = logging.getLogger(__name__)
 
@@ -24,39 +29,284 @@ class STATUS:
     
     INSERT = 'INSERT'
     UPDATE = 'UPDATE'
+    UNCHANGED = 'UNCHANGED'
     FAIL = 'FAIL'
     
 class DBHandler:
     '''
     Class to handle core database operations
+
+    One instance is shared by every handler of the same database file,
+    each thread reads through its own connection while the writes go
+    through a single connection guarded by a lock, the lock is held by the
+    writing thread from its first write until the commit, so a thread also
+    reads its own uncommitted writes and never sees the ones of another thread
+
+    Attributes:
+        __pool (dict): The instance of each database file
+        __pool_lock (threading.Lock): Protects the pool
+        __path (str): The path of the database file
+        __profile (dict): The connection profile (see db.sqlite_profile)
+        __writer (sqlite3.Connection): The connection used for the writes
+        __w_cursor (sqlite3.Cursor): The cursor of the write connection
+        __w_lock (threading.Lock): Held by the thread with a write transaction open
+        __w_owner (int): The thread holding the write lock (None if free)
+        __local (threading.local): The read connection and cursor of each thread
+        __readers (list): Every read connection opened, to close them
+        __queries (QueryCache): The compiled queries, keyed by their shape
     '''
 
-    def __new__(cls, db_path: str):
+    __pool = {}
+    __pool_lock = threading.Lock()
+
+    def __new__(cls, db_path: str, profile: dict | None = None):
         '''
-        Singleton pattern to ensure only one instance of the class is created
+        Returns the instance of the database file, it is created on the first call
 
         Parameters:
             db_path (str): Database file name
+            profile (dict | None): The connection profile (see db.sqlite_profile)
 
         Returns:
             DBHandler: Instance of the class
         '''
 
-        if not hasattr(cls, 'instance'):
-            cls.instance = super(DBHandler, cls).__new__(cls)
-            cls.instance.conn = sqlite3.connect(db_path)
-            cls.instance.cursor = cls.instance.conn.cursor()
-        return cls.instance
-    
+        key = (cls, db_path if db_path == ':memory:' else os.path.abspath(db_path))
+
+        with DBHandler.__pool_lock:
+            if key not in DBHandler.__pool:
+                instance = super(DBHandler, cls).__new__(cls)
+                instance.__open(db_path, profile)
+                DBHandler.__pool[key] = instance
+            return DBHandler.__pool[key]
+
+    def __open(self, db_path: str, profile: dict | None):
+        '''
+        Opens the write connection, the read connections are opened by each thread on first use
+
+        Parameters:
+            db_path (str): Database file name
+            profile (dict | None): The connection profile (see db.sqlite_profile)
+        '''
+
+        self.__path = db_path
+        self.__profile = profile
+        self.__writer = connect(db_path, profile, check_same_thread=False)
+        self.__w_cursor = self.__writer.cursor()
+        self.__w_lock = threading.Lock()
+        self.__w_owner = None
+        self.__local = threading.local()
+        self.__readers = []
+        self.__queries = QueryCache()
+
+    @property
+    def conn(self):
+        '''
+        The connection of the current thread, the write connection
+        while the thread has a write transaction open
+        '''
+
+        if self.__w_owner == threading.get_ident() or self.__path == ':memory:':
+            return self.__writer
+        if not hasattr(self.__local, 'conn'):
+            #only used by this thread, but closed by the one closing the handler
+            self.__local.conn = connect(self.__path, self.__profile, check_same_thread=False)
+            self.__local.cursor = self.__local.conn.cursor()
+            with DBHandler.__pool_lock:
+                self.__readers.append(self.__local.conn)
+        return self.__local.conn
+
+    @property
+    def cursor(self):
+        '''
+        The cursor of the connection of the current thread
+        '''
+
+        if self.conn is self.__writer:
+            return self.__w_cursor
+        return self.__local.cursor
+
+    def __write(self):
+        '''
+        Takes the write lock for the current thread, if it does not hold it already
+
+        Returns:
+            sqlite3.Cursor: The cursor of the write connection
+        '''
+
+        me = threading.get_ident()
+        if self.__w_owner != me:
+            self.__w_lock.acquire()
+            self.__w_owner = me
+        return self.__w_cursor
+
+    def __done(self, commit: bool):
+        '''
+        Commits and gives the write lock back, if asked to
+
+        Parameters:
+            commit (bool): Whether to commit, False keeps the transaction open
+        '''
+
+        if commit:
+            self.commit()
+
+    @contextmanager
+    def __writing(self, commit: bool = True):
+        '''
+        Holds the write lock for a single write and commits it, if asked to,
+        a write that raises outside a transaction block is rolled back and
+        the lock given back, inside a block the rollback is left to the block
+
+        Parameters:
+            commit (bool): Whether to commit, False keeps the transaction open
+
+        Returns:
+            sqlite3.Cursor: The cursor of the write connection
+        '''
+
+        cursor = self.__write()
+        try:
+            yield cursor
+        except BaseException:
+            if not self.__depth():
+                self.rollback()
+            raise
+        self.__done(commit)
+
+    def __depth(self) -> int:
+        '''
+        Returns:
+            int: The number of transaction blocks the current thread is in
+        '''
+
+        return getattr(self.__local, 'depth', 0)
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Groups the writes of the block in a single transaction, the commits of
+        the calls inside the block are suppressed, the block is committed at its
+        end or rolled back if it raises, nested blocks are savepoints that are
+        rolled back on their own
+
+        Returns:
+            DBHandler: The handler itself
+        '''
+
+        depth = self.__depth()
+        cursor = self.__write()
+
+        if depth == 0:
+            if not self.__writer.in_transaction:
+                cursor.execute('BEGIN')
+        else:
+            cursor.execute(f'SAVEPOINT sp_{depth}')
+        self.__local.depth = depth + 1
+
+        try:
+            yield self
+        except BaseException:
+            self.__local.depth = depth
+            self.rollback(f'sp_{depth}' if depth else None)
+            raise
+
+        self.__local.depth = depth
+        if depth == 0:
+            self.commit()
+        else:
+            cursor.execute(f'RELEASE sp_{depth}')
+
+    def deferred(self, table: str, columns: tuple, key_columns: tuple = (),
+                 size: int = 100, conflict: str = None) -> 'Deferred':
+        '''
+        Creates a buffer of rows written in a single transaction every size rows,
+        the rows are kept in memory so the write lock is only held while flushing
+
+        Parameters:
+            table (str): Table name
+            columns (tuple): Columns to write
+            key_columns (tuple): Columns identifying the rows to update (insert if empty)
+            size (int): Number of rows buffered before flushing
+            conflict (str): Conflict resolution strategy of the inserts
+
+        Returns:
+            Deferred: The buffer, flushed when used as a context manager exits
+        '''
+
+        if key_columns:
+            write = lambda rows: self.update_many(table, columns, rows, key_columns)
+        else:
+            write = lambda rows: self.insert_many(table, columns, rows, conflict)
+
+        return Deferred(self, write, size)
+
     def close(self):
         '''
-        Close the database connection
+        Close the database connections
         '''
 
-        self.conn.close()
+        with DBHandler.__pool_lock:
+            for key, instance in list(DBHandler.__pool.items()):
+                if instance is self:
+                    del DBHandler.__pool[key]
+            for conn in self.__readers:
+                conn.close()
+            self.__readers = []
+
+        self.__writer.close()
+
+    def compiled(self, key: tuple, build) -> CompiledQuery:
+        '''
+        Returns the compiled query of a shape, it is built on first use
+
+        Parameters:
+            key (tuple): The shape of the query, everything but the parameters
+            build (callable): Returns the text of the query
+
+        Returns:
+            CompiledQuery: The compiled query
+        '''
+
+        return self.__queries.get(key, build)
 
     def __fetchbuild(self, table, columns='*', joins=None, wheres=None,
                     order_by=None):
+        '''
+        Gets the compiled select query of the arguments and its parameters,
+        queries on subqueries are not cached and built every time
+
+        Returns:
+            tuple: The compiled query and its parameters
+        '''
+
+        build = lambda: self.__selectbuild(table, columns, joins, wheres, order_by)
+
+        joins = joins or []
+        wheres = wheres or []
+
+        if not isinstance(table, str) or not all(isinstance(j['table'], str) for j in joins):
+            query, params = build()
+            return CompiledQuery(query), params
+
+        j_conds = [j['condition'] if isinstance(j['condition'], list) else [] for j in joins]
+
+        key = ('select', table, 
+               tuple(columns) if isinstance(columns, list) else columns,
+               tuple((j['table'], 
+                      tuple(c.get('condition', '') for c in jc) 
+                          if isinstance(j['condition'], list) else j['condition'], 
+                      j.get('type', 'INNER')) for j, jc in zip(joins, j_conds)),
+               tuple(w['condition'] for w in wheres),
+               (tuple(order_by['columns']), order_by.get('direction', 'ASC')) if order_by else None)
+
+        params = [p for jc in j_conds for c in jc for p in c.get('params', ())]
+        params += [p for w in wheres for p in w['params']]
+
+        return self.compiled(key, lambda: build()[0]), params
+
+    def __selectbuild(self, table, columns='*', joins=None, wheres=None,
+                      order_by=None):
         qb = Sel().select(columns).table(table)
         if joins:
             for join in joins:
@@ -81,8 +331,7 @@ class DBHandler:
                                          joins, 
                                          wheres,
                                          order_by)
-        self.cursor.execute(query, params)
-        return self.cursor.fetchall()
+        return query.execute(self.cursor, params).fetchall()
 
     
     def fetchone(self, table, columns='*', joins=None, condition=None,
@@ -92,9 +341,8 @@ class DBHandler:
                                          joins, 
                                          condition,
                                          order_by)
-        self.cursor.execute(query, params)
-        logger.debug(query)
-        return self.cursor.fetchone()
+        logger.debug(query.sql)
+        return query.execute(self.cursor, params).fetchone()
     
     def fetchsingle(self, table, column, joins=None, condition=None,
                     order_by=None):
@@ -103,8 +351,7 @@ class DBHandler:
                                          joins, 
                                          condition,
                                          order_by)
-        self.cursor.execute(query, params)
-        r = self.cursor.fetchone()
+        r = query.execute(self.cursor, params).fetchone()
         return r[0] if r else None
         
     def insert(self, table, columns=(), values=(), conflict=None):
@@ -125,11 +372,189 @@ class DBHandler:
 
         logger.debug(query)
 
-        self.cursor.execute(query, values)
-        self.conn.commit()
-
-        return self.cursor.lastrowid
+        with self.__writing() as cursor:
+            cursor.execute(query, values)
+            return cursor.lastrowid
     
+    def commit(self):
+        '''
+        Commit the pending changes of the current thread and give the write lock back,
+        inside a transaction block the commit is left to the end of the block
+        '''
+
+        if self.__w_owner != threading.get_ident() or self.__depth():
+            return
+        try:
+            self.__writer.commit()
+        finally:
+            self.__w_owner = None
+            self.__w_lock.release()
+
+    def rollback(self, savepoint: str = None):
+        '''
+        Roll back the pending changes of the current thread and give the write lock back
+
+        Parameters:
+            savepoint (str): Only roll back the changes made after this savepoint,
+                             the transaction and the lock are kept
+        '''
+
+        if self.__w_owner != threading.get_ident():
+            return
+        if savepoint:
+            self.__w_cursor.execute(f'ROLLBACK TO {savepoint}')
+            self.__w_cursor.execute(f'RELEASE {savepoint}')
+            return
+        try:
+            self.__writer.rollback()
+        finally:
+            self.__w_owner = None
+            self.__w_lock.release()
+
+    def insert_many(self, table: str, columns: tuple = (), rows: list = (), 
+                    conflict: str = None, commit: bool = True) -> int:
+        '''
+        Insert many rows at once with a single commit
+
+        Parameters:
+            table (str): Table name
+            columns (tuple): Columns to insert (all columns if empty)
+            rows (list): Values of each row
+            conflict (str): Conflict resolution strategy
+            commit (bool): Whether to commit, False leaves it to the caller
+
+        Returns:
+            int: Number of rows inserted
+        '''
+
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        if not conflict:
+            conflict = CONFLICT.FAIL
+
+        query = f"""INSERT OR {conflict} INTO {table} 
+                    {"" if not columns else "(" + ", ".join(columns) + ")"}
+                         VALUES ({", ".join(["?" for _ in rows[0]])})"""
+
+        logger.debug(query)
+
+        with self.__writing(commit) as cursor:
+            cursor.executemany(query, rows)
+            count = cursor.rowcount
+
+        return count
+
+    def update_many(self, table: str, columns: tuple, rows: list,
+                    key_columns: tuple, commit: bool = True) -> int:
+        '''
+        Update many rows at once with a single commit
+
+        Parameters:
+            table (str): Table name
+            columns (tuple): Columns to update
+            rows (list): Values of the columns followed by the values of the key of each row
+            key_columns (tuple): Columns identifying the rows
+            commit (bool): Whether to commit, False leaves it to the caller
+
+        Returns:
+            int: Number of rows updated
+        '''
+
+        rows = list(rows)
+        if not rows:
+            return 0
+
+        query = f"""UPDATE {table} SET {", ".join([f"{c} = ?" for c in columns])}
+                    WHERE {" AND ".join([f"{c} = ?" for c in key_columns])}"""
+
+        logger.debug(query)
+
+        with self.__writing(commit) as cursor:
+            cursor.executemany(query, rows)
+            count = cursor.rowcount
+
+        return count
+
+    def upsert_many(self, table: str, columns: tuple, rows: list, 
+                    conflict_columns: tuple, commit: bool = True,
+                    existing: dict = None, keep_columns: tuple = ()) -> list[tuple[int, str]]:
+        '''
+        Insert many rows, updating the rows that already exist, with a single commit
+
+        The rows are written with one executemany of an
+        INSERT ... ON CONFLICT DO UPDATE statement, the IDs are then read
+        back in chunks since executemany cannot return the RETURNING rows
+
+        Parameters:
+            table (str): Table name
+            columns (tuple): Columns to insert
+            rows (list): Values of each row
+            conflict_columns (tuple): Columns of the unique constraint
+            commit (bool): Whether to commit, False leaves it to the caller
+            existing (dict): The IDs of the keys already stored, if the caller knows them
+            keep_columns (tuple): Columns only written when the row is inserted
+
+        Returns:
+            list: The ID and STATUS of each row, in the same order as rows
+        '''
+
+        rows = list(rows)
+        if not rows:
+            return []
+
+        ci = [columns.index(c) for c in conflict_columns]
+        keys = [tuple(r[i] for i in ci) for r in rows]
+
+        if existing is None:
+            existing = self.__ids_by_key(table, conflict_columns, keys)
+
+        upd = [c for c in columns if c not in conflict_columns and c not in keep_columns]
+        query = f"""INSERT INTO {table} ({", ".join(columns)})
+                         VALUES ({", ".join(["?" for _ in columns])})
+                    ON CONFLICT ({", ".join(conflict_columns)}) DO UPDATE 
+                         SET {", ".join([f"{c} = excluded.{c}" for c in upd])}"""
+
+        logger.debug(query)
+
+        with self.__writing(commit) as cursor:
+            cursor.executemany(query, rows)
+            new = self.__ids_by_key(table, conflict_columns, 
+                                    [k for k in keys if k not in existing])
+
+        return [(existing[k], STATUS.UPDATE) if k in existing else (new[k], STATUS.INSERT)
+                for k in keys]
+
+    def __ids_by_key(self, table: str, key_columns: tuple, keys: list, 
+                     chunk: int = 500) -> dict:
+        '''
+        Maps the values of a unique key to the IDs of the rows holding them
+
+        Parameters:
+            table (str): Table name
+            key_columns (tuple): Columns of the unique key
+            keys (list): Tuples of key values to look up
+            chunk (int): Number of keys looked up by each query
+
+        Returns:
+            dict: The ID of each key found
+        '''
+
+        ids = {}
+        cols = ', '.join(key_columns)
+        nk = len(key_columns)
+
+        for i in range(0, len(keys), chunk):
+            part = keys[i:i + chunk]
+            values = ', '.join(['(' + ', '.join(['?'] * nk) + ')' for _ in part])
+            query = f'SELECT id, {cols} FROM {table} WHERE ({cols}) IN (VALUES {values})'
+            self.cursor.execute(query, [v for k in part for v in k])
+            for row in self.cursor.fetchall():
+                ids[tuple(row[1:])] = row[0]
+
+        return ids
+
     def insert_update(self, table, columns=(), values=(), conflict_columns=()):
         
         sel_val = []
@@ -149,10 +574,9 @@ class DBHandler:
                          'params': sel_val}])
             return id[0][0], STATUS.UPDATE
         else:
-            self.insert(table, columns, values)
-            return self.cursor.lastrowid, STATUS.INSERT
+            return self.insert(table, columns, values), STATUS.INSERT
     
-    def update(self, table, columns=(), values=(), condition=None):
+    def update(self, table, columns=(), values=(), condition=None, commit=True):
         lc = len(columns)
         lv = len(values)
 
@@ -165,19 +589,23 @@ class DBHandler:
         if lc != lv:
             raise ValueError("Columns and values must have the same length: " + str(lc) + " != " + str(lv))
         
-        q = Upd().table(table).set(columns, values)
-        
-        for where in condition:
-            q.where(where['condition'], where['params'])
+        def build():
+            q = Upd().table(table).set(columns, values)
+            for where in condition:
+                q.where(where['condition'], where['params'])
+            return q.build()[0]
 
-        query, params = q.build()
+        query = self.compiled(('update', table, tuple(columns), 
+                               tuple(w['condition'] for w in condition)), build)
+        params = list(values) + [p for w in condition for p in w['params']]
 
-        logger.debug(query)
+        logger.debug(query.sql)
 
-        self.cursor.execute(query, params)
-        self.conn.commit()
+        with self.__writing(commit) as cursor:
+            query.execute(cursor, params)
 
-    def delete(self, table: str, condition: str, params: set = ()):
+    def delete(self, table: str, condition: str, params: set = (), 
+               commit: bool = True):
         '''
         Delete rows from a table
 
@@ -185,8 +613,58 @@ class DBHandler:
             table (str): Table name
             condition (str): Condition to delete rows
             params (tuple): Parameters for the condition
+            commit (bool): Whether to commit, False leaves it to the caller
         '''
 
         query = f"DELETE FROM {table} WHERE {condition}"
-        self.cursor.execute(query, params)
-        self.conn.commit()
\ No newline at end of file
+        with self.__writing(commit) as cursor:
+            cursor.execute(query, params)
+
+class Deferred:
+    '''
+    Buffer of rows written together, see DBHandler.deferred
+
+    Attributes:
+        __db (DBHandler): The database handler
+        __write (callable): Writes a list of rows
+        __size (int): Number of rows buffered before flushing
+        __rows (list): The rows not written yet
+    '''
+
+    def __init__(self, db: DBHandler, write, size: int = 100):
+        self.__db = db
+        self.__write = write
+        self.__size = max(size, 1)
+        self.__rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        #the rows added before an error are still written
+        self.flush()
+        return False
+
+    def add(self, row: tuple):
+        '''
+        Buffers a row, flushing the buffer once it is full
+
+        Parameters:
+            row (tuple): The values of the row
+        '''
+
+        self.__rows.append(row)
+        if len(self.__rows) >= self.__size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the buffered rows in a single transaction
+        '''
+
+        if not self.__rows:
+            return
+
+        rows, self.__rows = self.__rows, []
+        with self.__db.transaction():
+            self.__write(rows)
@@ -0,0 +1,195 @@
+import sqlite3
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+'''
+The schema of the database is built by numbered migrations, the number of the
+last one applied is stored in PRAGMA user_version so each one runs only once.
+Every step checks the current schema before changing it, so databases created
+with the old schema script are brought to the same state whatever revision
+they reached, while user_version was still 0
+'''
+
+def _columns(conn: sqlite3.Connection, table: str) -> list[str]:
+    '''
+    Gets the columns of a table
+
+    Parameters:
+        conn (sqlite3.Connection): The database connection
+        table (str): The name of the table
+
+    Returns:
+        list: The names of the columns
+    '''
+    return [c[1] for c in conn.execute(f"PRAGMA table_info('{table}')")]
+
+def _add_column(conn: sqlite3.Connection, table: str, column: str, definition: str):
+    '''
+    Adds a column to a table if it does not exist yet
+
+    Parameters:
+        conn (sqlite3.Connection): The database connection
+        table (str): The name of the table
+        column (str): The name of the column
+        definition (str): The type and constraints of the column
+    '''
+    if column not in _columns(conn, table):
+        conn.execute(f"ALTER TABLE '{table}' ADD COLUMN '{column}' {definition}")
+
+def _base(conn: sqlite3.Connection):
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'artists' (
+                        'id' INTEGER PRIMARY KEY,
+                        'mbid' VARCHAR(36) NOT NULL UNIQUE,
+                        'name' VARCHAR(255) NOT NULL,
+                        'disambiguation' VARCHAR(512)
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'types' (
+                        'id' INTEGER PRIMARY KEY,
+                        'name' VARCHAR(255) NOT NULL
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'releases' (
+                        'id' INTEGER PRIMARY KEY,
+                        'mbid' VARCHAR(36) NOT NULL UNIQUE,
+                        'artist_mbid' INTEGER NOT NULL,
+                        'title' VARCHAR(255) NOT NULL,
+                        'release_date' DATE NOT NULL,
+                        'last_updated' TIMESTAMP NOT NULL,
+                        'primary_type' INTEGER NOT NULL,
+                        FOREIGN KEY ('artist_mbid') REFERENCES 'artists' ('id'),
+                        FOREIGN KEY ('primary_type') REFERENCES 'release_types' ('id')
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'types_releases' (
+                        'type_id' INTEGER NOT NULL,
+                        'release_id' INTEGER NOT NULL,
+                        PRIMARY KEY ('type_id', 'release_id'),
+                        FOREIGN KEY ('type_id') REFERENCES 'types' ('id'),
+                        FOREIGN KEY ('release_id') REFERENCES 'releases' ('id')
+                    )""")
+    conn.executemany("INSERT OR IGNORE INTO 'types' ('id', 'name') VALUES (?, ?)",
+                     enumerate(['Album', 'Single', 'EP', 'Compilation', 'Soundtrack',
+                                'Spokenword', 'Interview', 'Audiobook', 'Live', 'Remix',
+                                'Mixtape', 'Demo', 'Bootleg', 'DJ-mix', 'Other'], 1))
+
+def _artist_refresh_time(conn: sqlite3.Connection):
+    _add_column(conn, 'artists', 'last_updated', 'TIMESTAMP DEFAULT NULL')
+
+def _last_notified(conn: sqlite3.Connection):
+    _add_column(conn, 'releases', 'last_notified', 'DATE DEFAULT NULL')
+
+    #the notified flag of the older schema becomes the date it was replaced on
+    if 'notified' in _columns(conn, 'releases'):
+        conn.execute("UPDATE 'releases' SET 'last_notified' = '2024-09-07' WHERE notified = 1")
+        conn.execute("ALTER TABLE 'releases' DROP COLUMN 'notified'")
+
+def _telegram_ack(conn: sqlite3.Connection):
+    _add_column(conn, 'releases', 'last_msg_id', 'INTEGER DEFAULT NULL')
+    _add_column(conn, 'releases', 'still_interesting', 'BOOLEAN DEFAULT TRUE')
+
+def _rg_count(conn: sqlite3.Connection):
+    _add_column(conn, 'artists', 'rg_count', 'INTEGER DEFAULT NULL')
+
+def _fingerprint(conn: sqlite3.Connection):
+    _add_column(conn, 'releases', 'fingerprint', 'VARCHAR(40) DEFAULT NULL')
+
+def _refresh_interval(conn: sqlite3.Connection):
+    _add_column(conn, 'artists', 'refresh_interval', 'INTEGER DEFAULT NULL')
+
+def _refresh_journal(conn: sqlite3.Connection):
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'refresh_runs' (
+                        'id' INTEGER PRIMARY KEY,
+                        'started' TIMESTAMP NOT NULL,
+                        'finished' TIMESTAMP DEFAULT NULL
+                    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS 'refresh_progress' (
+                        'run_id' INTEGER NOT NULL,
+                        'artist_id' INTEGER NOT NULL,
+                        'batch' INTEGER NOT NULL,
+                        'page_offset' INTEGER NOT NULL DEFAULT 0,
+                        'done' BOOLEAN NOT NULL DEFAULT FALSE,
+                        PRIMARY KEY ('run_id', 'artist_id'),
+                        FOREIGN KEY ('run_id') REFERENCES 'refresh_runs' ('id'),
+                        FOREIGN KEY ('artist_id') REFERENCES 'artists' ('id')
+                    )""")
+
+def _leases(conn: sqlite3.Connection):
+    _add_column(conn, 'artists', 'lease_owner', 'VARCHAR(255) DEFAULT NULL')
+    _add_column(conn, 'artists', 'lease_expires', 'INTEGER DEFAULT NULL')
+    _add_column(conn, 'refresh_runs', 'owner', 'VARCHAR(255) DEFAULT NULL')
+
+def _fingerprint_without_artist(conn: sqlite3.Connection):
+    #same fields as MusicDB.release_fingerprint, kept here as they were when the artist was dropped
+    types = {}
+    for t_id, r_id in conn.execute("SELECT type_id, release_id FROM 'types_releases'"):
+        types.setdefault(r_id, []).append(t_id)
+
+    rows = []
+    for r_id, title, r_date, pt_id in conn.execute(
+            "SELECT id, title, CAST(release_date AS TEXT), primary_type FROM 'releases' "
+            "WHERE fingerprint IS NOT NULL"):
+        fields = [title, r_date, str(pt_id)] + [str(t) for t in sorted(types.get(r_id, []))]
+        rows.append((hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest(), r_id))
+
+    conn.executemany("UPDATE 'releases' SET 'fingerprint' = ? WHERE id = ?", rows)
+
+def _indexes(conn: sqlite3.Connection):
+    for table, column in (('releases', 'release_date'),
+                          ('releases', 'artist_mbid'),
+                          ('releases', 'last_msg_id'),
+                          ('artists', 'last_updated'),
+                          ('artists', 'name'),
+                          ('types', 'name'),
+                          ('types_releases', 'release_id')):
+        conn.execute(f"CREATE INDEX IF NOT EXISTS 'idx_{table}_{column}' ON '{table}' ('{column}')")
+    conn.execute('ANALYZE')
+
+MIGRATIONS = [
+    (1, 'Base tables', _base),
+    (2, 'Refresh time of the artists', _artist_refresh_time),
+    (3, 'Notification date of the releases', _last_notified),
+    (4, 'Telegram acknowledgements', _telegram_ack),
+    (5, 'Release group count of the artists', _rg_count),
+    (6, 'Fingerprint of the releases', _fingerprint),
+    (7, 'Refresh interval of the artists', _refresh_interval),
+    (8, 'Journal of the refresh runs', _refresh_journal),
+    (9, 'Leases of the artists', _leases),
+    (10, 'Indexes of the hot paths', _indexes),
+    (11, 'Fingerprint of the releases without the artist', _fingerprint_without_artist),
+]
+
+def migrate(conn: sqlite3.Connection) -> int:
+    '''
+    Applies the migrations the database is missing, each one in its own transaction
+
+    The version is read again once the write lock is held,
+    so concurrent processes never apply the same migration twice
+
+    Parameters:
+        conn (sqlite3.Connection): The database connection
+
+    Returns:
+        int: The version of the database
+    '''
+    version = conn.execute('PRAGMA user_version').fetchone()[0]
+
+    for number, description, step in MIGRATIONS:
+        if number <= version:
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= number:
+                conn.rollback()
+                continue
+            step(conn)
+            conn.execute(f'PRAGMA user_version = {number}')
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            logger.error(f'Migration {number} ({description}) failed')
+            raise
+        logger.info(f'Applied migration {number}: {description}')
+        version = number
+
+    return version
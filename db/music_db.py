@@ -1,6 +1,11 @@
+import uuid
+import hashlib
 import logging
 
-from db.db_handler import DBHandler as DBH
+from datetime import datetime as dt
+
+from db.db_handler import DBHandler as DBH, STATUS
+from db.migrations import migrate
 from db.query_builder import SelectQuery as Sel, UpdateQuery as Upd
 
 logger = logging.getLogger(__name__)
@@ -8,20 +13,194 @@ logger = logging.getLogger(__name__)
 class MusicDB(DBH):
     '''
     Extension of the DBHandler class to handle db operations specific to mb_releases
+
+    Attributes:
+        __types (dict): Cache of the types table, name to ID (None until loaded)
+        __releases (dict): Index of the known releases, MBID bytes to ID and fingerprint (None until loaded)
     '''
 
-    def __new__(cls, db_path: str):
+    def __new__(cls, db_path: str, profile: dict | None = None):
         '''
-        Singleton pattern to ensure only one instance of the class is created
+        Returns the shared instance of the database file
 
         Parameters:
             db_path (str): Database file path
+            profile (dict | None): The connection profile (see db.sqlite_profile)
 
         Returns:
             MusicDB: Instance of the class
         '''
 
-        return super(MusicDB, cls).__new__(cls, db_path)
+        return super(MusicDB, cls).__new__(cls, db_path, profile)
+
+    def __init__(self, db_path: str, profile: dict | None = None):
+        #the instance is shared by every MusicDB of the same file, it is set up once
+        if hasattr(self, '_MusicDB__types'):
+            return
+
+        migrate(self.conn)
+        self.__types = None
+        self.__releases = None
+
+    def insert(self, table, columns=(), values=(), conflict=None):
+        '''
+        Insert a row, invalidating the caches of the table
+        '''
+
+        self.__invalidate(table)
+        return super().insert(table, columns, values, conflict)
+
+    def insert_many(self, table, columns=(), rows=(), conflict=None, commit=True):
+        '''
+        Insert many rows, invalidating the caches of the table
+        '''
+
+        self.__invalidate(table)
+        return super().insert_many(table, columns, rows, conflict, commit)
+
+    def upsert_many(self, table, columns, rows, conflict_columns, commit=True, existing=None,
+                    keep_columns=()):
+        '''
+        Insert or update many rows, invalidating the caches of the table
+        '''
+
+        self.__invalidate(table)
+        return super().upsert_many(table, columns, rows, conflict_columns, commit, existing,
+                                   keep_columns)
+
+    def rollback(self, savepoint=None):
+        '''
+        Roll back the pending changes, dropping the caches that may hold rows rolled back
+        '''
+
+        self.__types = None
+        self.__releases = None
+        super().rollback(savepoint)
+
+    def __invalidate(self, table: str):
+        '''
+        Drops the cache of a table, it will be reloaded on the next lookup
+
+        Parameters:
+            table (str): The table that is being modified
+        '''
+
+        if table == 'types':
+            self.__types = None
+        elif table == 'releases':
+            self.__releases = None
+
+    def __type_cache(self) -> dict:
+        '''
+        Returns the cache of the types table, loading it if needed
+
+        Returns:
+            dict: The ID of each type name
+        '''
+
+        if self.__types is None:
+            self.__types = {name: id for id, name in self.fetchall('types', ['id', 'name'])}
+        return self.__types
+
+    def __release_index(self) -> dict:
+        '''
+        Returns the index of the known releases, loading it if needed,
+        the MBIDs are kept as 16 bytes keys to keep the index compact
+
+        Returns:
+            dict: The ID and fingerprint of each release MBID
+        '''
+
+        if self.__releases is None:
+            self.__releases = {self.__mbid_key(mbid): (id, fp)
+                               for id, mbid, fp in self.fetchall('releases', ['id', 'mbid', 'fingerprint'])}
+        return self.__releases
+
+    def __mbid_key(self, mbid: str) -> bytes:
+        '''
+        Converts an MBID to the key used by the release index
+
+        Parameters:
+            mbid (str): The MBID to convert
+
+        Returns:
+            bytes: The 16 bytes of the UUID (the encoded string if it is not a UUID)
+        '''
+
+        try:
+            return uuid.UUID(mbid).bytes
+        except ValueError:
+            return mbid.encode('utf-8')
+
+    def release_fingerprint(self, title: str, r_date: str,
+                            pt_id: int, st_ids: list) -> str:
+        '''
+        Computes the fingerprint of the fields of a release shown in the outputs,
+        a release whose fingerprint did not change does not need to be written
+
+        The artist is left out, a release group credited to several tracked
+        artists is found in the results of each of them and keeps the artist
+        it was first stored with
+
+        Parameters:
+            title (str): The title of the release
+            r_date (str): The release date
+            pt_id (int): The ID of the primary type
+            st_ids (list): The IDs of the secondary types
+
+        Returns:
+            str: The fingerprint of the release
+        '''
+
+        fields = [title, r_date, str(pt_id)] + [str(t) for t in sorted(st_ids)]
+        return hashlib.sha1('\x1f'.join(fields).encode('utf-8')).hexdigest()
+
+    def upsert_releases(self, rows: list, commit: bool = True) -> list[tuple[int, str]]:
+        '''
+        Inserts or updates many releases, the existing ones are found
+        in the release index instead of being looked up in the database
+        and the ones whose fingerprint did not change are not written at all,
+        the artist of a release is only set when it is inserted
+
+        Parameters:
+            rows (list): The values of each release (mbid, artist_mbid, title, 
+                         release_date, last_updated, primary_type, fingerprint)
+            commit (bool): Whether to commit, False leaves it to the caller
+
+        Returns:
+            list: The ID and STATUS of each release, in the same order as rows
+        '''
+
+        index = self.__release_index()
+        existing = {}
+        write = []
+
+        for r in rows:
+            known = index.get(self.__mbid_key(r[0]))
+            if known and known[1] == r[6]:
+                continue
+            if known:
+                existing[(r[0],)] = known[0]
+            write.append(r)
+
+        stored = super().upsert_many('releases',
+                                     columns=('mbid', 'artist_mbid', 'title',
+                                              'release_date', 'last_updated',
+                                              'primary_type', 'fingerprint'),
+                                     rows=write,
+                                     conflict_columns=('mbid',),
+                                     commit=commit,
+                                     existing=existing,
+                                     keep_columns=('artist_mbid',))
+
+        for r, (rid, _) in zip(write, stored):
+            index[self.__mbid_key(r[0])] = (rid, r[6])
+
+        written = {r[0]: s for r, s in zip(write, stored)}
+
+        return [written[r[0]] if r[0] in written 
+                else (index[self.__mbid_key(r[0])][0], STATUS.UNCHANGED)
+                for r in rows]
     
     def __parse_cols(self, columns: str | list) -> int:
         '''
@@ -142,7 +321,7 @@ class MusicDB(DBH):
     
     def get_type_id(self, t_name: str) -> int | None:
         '''
-        Gets the ID of a type by its name
+        Gets the ID of a type by its name, from the types cache
 
         Parameters:
             t_name (str): The name of the type
@@ -152,8 +331,7 @@ class MusicDB(DBH):
             None: If the type is not found
         '''
         
-        return self.__get_type('id', [{'condition': 'name = ?', 
-                                      'params': (t_name,)}])
+        return self.__type_cache().get(t_name)
 
     def get_type_name(self, t_id: int) -> str | None:
         '''
@@ -191,7 +369,7 @@ class MusicDB(DBH):
     
     def get_release_id(self, r_mbid: str) -> int | None:
         '''
-        Gets the ID of a release by its name
+        Gets the ID of a release by its MBID, from the release index
 
         Parameters:
             r_mbid (str): The MBID of the release
@@ -201,8 +379,8 @@ class MusicDB(DBH):
             None: If the release is not found
         '''
 
-        return self.__get_release('id', [{'condition': 'mbid = ?', 
-                                         'params': (r_mbid,)}])
+        known = self.__release_index().get(self.__mbid_key(r_mbid))
+        return known[0] if known else None
     
     def get_release_title(self, r_id: int) -> str | None:
         '''
@@ -219,6 +397,270 @@ class MusicDB(DBH):
         return self.__get_release('title', [{'condition': 'id = ?',
                                             'params': (r_id,)}])
     
+    def get_artist_activity(self, a_ids: list = None) -> dict:
+        '''
+        Gets how active each artist is, from the releases in the database
+
+        Parameters:
+            a_ids (list): The IDs of the artists (all artists if None)
+
+        Returns:
+            dict: For each artist ID, the number of releases in the last year,
+                  the number of releases announced or with a partial date
+                  that is not over yet and the date of the last release already out
+        '''
+
+        '''
+        Dates with only the year are stored as integers because of the
+        affinity of the column, they are cast back to text to be compared
+        '''
+        where = ''
+        params = ()
+        if a_ids is not None:
+            where = 'WHERE artist_mbid IN (' + ', '.join(['?' for _ in a_ids]) + ')'
+            params = tuple(a_ids)
+
+        query = f"""SELECT artist_mbid,
+                           SUM(release_date >= date('now', '-1 year')),
+                           SUM(CASE length(release_date)
+                                   WHEN 10 THEN release_date >= date('now')
+                                   WHEN 7 THEN release_date >= strftime('%Y-%m', 'now')
+                                   ELSE release_date >= strftime('%Y', 'now')
+                               END),
+                           MAX(CASE WHEN release_date < date('now') THEN release_date END)
+                    FROM (SELECT artist_mbid, CAST(release_date AS TEXT) AS release_date
+                          FROM releases
+                          {where})
+                    GROUP BY artist_mbid"""
+
+        logger.debug(query)
+        self.cursor.execute(query, params)
+        return {a_id: (recent or 0, pending or 0, last) 
+                for a_id, recent, pending, last in self.cursor.fetchall()}
+
+    def start_refresh(self, batches: list, owner: str) -> int:
+        '''
+        Records a new refresh run in the journal, with the batch of each artist
+
+        Parameters:
+            batches (list): The IDs of the artists of each batch, in refresh order
+            owner (str): The process running the refresh
+
+        Returns:
+            int: The ID of the run
+        '''
+
+        run_id = self.insert('refresh_runs', 
+                             columns=('started', 'owner'), 
+                             values=(dt.now().strftime('%Y-%m-%d %H:%M:%S'), owner))
+
+        self.insert_many('refresh_progress', 
+                         columns=('run_id', 'artist_id', 'batch'),
+                         rows=[(run_id, a_id, b_no) 
+                               for b_no, batch in enumerate(batches) 
+                               for a_id in batch])
+        return run_id
+
+    def get_unfinished_refresh(self, owner: str) -> tuple[int | None, dict]:
+        '''
+        Gets the last refresh run of a process that did not reach its end and what is left of it
+
+        Parameters:
+            owner (str): The process that ran the refresh
+
+        Returns:
+            tuple: The ID of the run (None if every run finished) and, for each
+                   batch left, the IDs of its artists and the offset of its next page
+        '''
+
+        run_id = self.fetchsingle('refresh_runs', 'id', 
+                                  condition=[{'condition': 'finished IS NULL AND owner = ?', 
+                                              'params': (owner,)}],
+                                  order_by={'columns': ('id',), 
+                                            'direction': 'DESC'})
+        if not run_id:
+            return None, {}
+
+        pending = {}
+        for b_no, a_id, offset in self.fetchall('refresh_progress', 
+                                                ['batch', 'artist_id', 'page_offset'],
+                                                wheres=[{'condition': 'run_id = ? AND done = 0',
+                                                         'params': (run_id,)}]):
+            pending.setdefault(b_no, ([], offset))[0].append(a_id)
+
+        if not pending:
+            self.finish_refresh(run_id)
+            return None, {}
+
+        return run_id, pending
+
+    def checkpoint_refresh(self, run_id: int, b_no: int, offset: int, 
+                           done: bool = False, commit: bool = True):
+        '''
+        Records the progress of a batch of a refresh run
+
+        Parameters:
+            run_id (int): The ID of the run
+            b_no (int): The number of the batch
+            offset (int): The offset of the next page to fetch
+            done (bool): Whether every page of the batch was stored
+            commit (bool): Whether to commit, False leaves it to the caller
+        '''
+
+        self.update('refresh_progress', 
+                    columns=('page_offset', 'done'),
+                    values=(offset, done),
+                    condition=[{'condition': 'run_id = ? AND batch = ?',
+                                'params': (run_id, b_no)}],
+                    commit=commit)
+
+    def finish_refresh(self, run_id: int):
+        '''
+        Drops a finished refresh run and its progress from the journal,
+        together with the runs marked as finished by older versions
+
+        Parameters:
+            run_id (int): The ID of the run
+        '''
+
+        self.delete('refresh_progress', 'run_id = ?', (run_id,), commit=False)
+        self.delete('refresh_runs', 'id = ? OR finished IS NOT NULL', (run_id,))
+
+    def claim_artists(self, owner: str, a_ids: list, ttl: int, 
+                      wheres: list = [], chunk: int = 500) -> list[int]:
+        '''
+        Leases the artists that are not leased by another worker, or whose lease expired
+
+        Each statement is atomic, so concurrent workers never lease the same artist,
+        the selection conditions are checked again by the same statement, so an
+        artist refreshed by another worker since it was selected is not leased
+
+        Parameters:
+            owner (str): The process taking the leases
+            a_ids (list): The IDs of the artists to lease
+            ttl (int): The seconds before the leases expire
+            wheres (list): The conditions the artists were selected with
+            chunk (int): The number of artists leased per statement
+
+        Returns:
+            list: The IDs of the artists leased by the worker
+        '''
+
+        t = int(dt.now().timestamp())
+        claimed = []
+        for i in range(0, len(a_ids), chunk):
+            ids = tuple(a_ids[i:i + chunk])
+            in_ids = 'id IN (' + ', '.join(['?' for _ in ids]) + ')'
+            self.update('artists', 
+                        columns=('lease_owner', 'lease_expires'),
+                        values=(owner, t + ttl),
+                        condition=[{'condition': in_ids, 'params': ids},
+                                   {'condition': '(lease_owner IS NULL OR lease_owner = ? OR lease_expires < ?)',
+                                    'params': (owner, t)}] + list(wheres))
+            claimed += [a[0] for a in self.fetchall('artists', ['id'],
+                                                   wheres=[{'condition': in_ids, 'params': ids},
+                                                           {'condition': 'lease_owner = ?', 
+                                                            'params': (owner,)}])]
+        return claimed
+
+    def get_lease_owners(self, worker: str) -> list[str]:
+        '''
+        Gets the processes of a worker holding leases or unfinished refresh runs
+
+        Parameters:
+            worker (str): The worker
+
+        Returns:
+            list: The lease tokens of the processes
+        '''
+
+        query = """SELECT lease_owner FROM artists 
+                   WHERE lease_owner = ? OR substr(lease_owner, 1, ?) = ?
+                   UNION
+                   SELECT owner FROM refresh_runs 
+                   WHERE finished IS NULL AND (owner = ? OR substr(owner, 1, ?) = ?)"""
+
+        logger.debug(query)
+        self.cursor.execute(query, (worker, len(worker) + 1, worker + ':') * 2)
+        return [o for o, in self.cursor.fetchall()]
+
+    def take_over_leases(self, owner: str, dead: list, commit: bool = True):
+        '''
+        Moves the leases and the unfinished refresh runs of processes no longer running to another one
+
+        Parameters:
+            owner (str): The process taking them over
+            dead (list): The processes no longer running
+            commit (bool): Whether to commit, False leaves it to the caller
+        '''
+
+        if not dead:
+            return
+
+        in_dead = 'IN (' + ', '.join(['?' for _ in dead]) + ')'
+        self.update('artists',
+                    columns=('lease_owner',),
+                    values=(owner,),
+                    condition=[{'condition': 'lease_owner ' + in_dead, 'params': tuple(dead)}],
+                    commit=False)
+        self.update('refresh_runs',
+                    columns=('owner',),
+                    values=(owner,),
+                    condition=[{'condition': 'finished IS NULL AND owner ' + in_dead, 
+                                'params': tuple(dead)}],
+                    commit=commit)
+        logger.info('Took over the leases of ' + ', '.join(dead))
+
+    def renew_leases(self, owner: str, ttl: int, commit: bool = True):
+        '''
+        Extends the leases still held by a worker
+
+        Parameters:
+            owner (str): The process holding the leases
+            ttl (int): The seconds before the leases expire
+            commit (bool): Whether to commit, False leaves it to the caller
+        '''
+
+        self.update('artists', 
+                    columns=('lease_expires',),
+                    values=(int(dt.now().timestamp()) + ttl,),
+                    condition=[{'condition': 'lease_owner = ?', 'params': (owner,)}],
+                    commit=commit)
+
+    def release_leases(self, owner: str, commit: bool = True):
+        '''
+        Releases the leases still held by a worker
+
+        Parameters:
+            owner (str): The process holding the leases
+            commit (bool): Whether to commit, False leaves it to the caller
+        '''
+
+        self.update('artists', 
+                    columns=('lease_owner', 'lease_expires'),
+                    values=(None, None),
+                    condition=[{'condition': 'lease_owner = ?', 'params': (owner,)}],
+                    commit=commit)
+
+    def get_next_refresh(self, interval: int) -> int | None:
+        '''
+        Gets when the next artist will be due for a refresh
+
+        Parameters:
+            interval (int): The refresh interval of artists without their own
+
+        Returns:
+            int | None: The UNIX time of the next refresh (0 if an artist was never refreshed),
+                        None if there are no artists
+        '''
+
+        query = """SELECT MIN(COALESCE(last_updated + COALESCE(refresh_interval, ?), 0))
+                   FROM artists"""
+
+        logger.debug(query)
+        self.cursor.execute(query, (interval,))
+        return self.cursor.fetchone()[0]
+
     def get_releasing(self, keep_types: list = [], 
                      d_past: int = -1, d_fut: int = -1,
                      add_cols: list = [],
@@ -239,51 +681,68 @@ class MusicDB(DBH):
             None: If no releases are found
         '''
 
-        base_select = ['r.id', 'mbid', 'artist_mbid', 
-                       'title', 'release_date', 't2.name']
+        #the text of the query only depends on the number of types, the columns,
+        #which date limits are set and the other conditions, it is compiled once per shape
+        has_past = d_past != None and d_past >= 0
+        has_fut = d_fut != None and d_fut >= 0
+
+        def build():
+            base_select = ['r.id', 'mbid', 'artist_mbid', 
+                           'title', 'release_date', 't2.name']
         
-        kt_str = ', '.join(['?' for _ in keep_types])
+            kt_str = ', '.join(['?' for _ in keep_types])
 
-        base_select += add_cols
+            base_select += add_cols
 
-        exq = Sel().select('1').table('types_releases').where('release_id = r.id')
+            exq = Sel().select('1').table('types_releases').where('release_id = r.id')
 
-        fq = Sel().select(base_select).table('releases', 'r')            
+            fq = Sel().select(base_select).table('releases', 'r')            
 
-        fqj = [{'condition': 'r.primary_type = t2.id'}]
-        fqj.append({'condition': f"t2.name IN ({kt_str})", 'params': keep_types})
+            fqj = [{'condition': 'r.primary_type = t2.id'}]
+            fqj.append({'condition': f"t2.name IN ({kt_str})", 'params': keep_types})
 
-        fq.join('types', fqj, alias='t2')
-        fq.where(f"NOT EXISTS ({exq.build()[0]})")
+            fq.join('types', fqj, alias='t2')
+            fq.where(f"NOT EXISTS ({exq.build()[0]})")
 
-        sq = Sel().select(base_select).table('types_releases', 'tr')
+            sq = Sel().select(base_select).table('types_releases', 'tr')
 
-        sqj = [{'condition': 'tr.type_id = t.id'}]
-        sqj.append({'condition': f"t.name IN ({kt_str})", 'params': keep_types})
+            sqj = [{'condition': 'tr.type_id = t.id'}]
+            sqj.append({'condition': f"t.name IN ({kt_str})", 'params': keep_types})
         
-        sq.join('types', sqj, alias='t')
-        sq.join('releases', 'r.id = tr.release_id', alias='r')
-        sq.join('types', 'r.primary_type = t2.id', alias='t2')
+            sq.join('types', sqj, alias='t')
+            sq.join('releases', 'r.id = tr.release_id', alias='r')
+            sq.join('types', 'r.primary_type = t2.id', alias='t2')
 
-        fq.union(sq)
+            fq.union(sq)
 
-        qb = Sel().table(fq)
+            qb = Sel().table(fq)
 
-        if d_past != None and d_past >= 0:
-            qb.where('release_date >= date("now", ?)', (f'-{d_past} days',))
+            if has_past:
+                qb.where('release_date >= date("now", ?)', (f'-{d_past} days',))
         
-        if d_fut != None and d_fut >= 0:
-            qb.where('release_date <= date("now", ?)', (f'+{d_fut} days',))
+            if has_fut:
+                qb.where('release_date <= date("now", ?)', (f'+{d_fut} days',))
 
-        for cond in o_condition:
-            qb.where(cond['condition'], cond.get('params', ()))
+            for cond in o_condition:
+                qb.where(cond['condition'], cond.get('params', ()))
 
-        qb.order_by(('release_date', 'title'), order)
+            qb.order_by(('release_date', 'title'), order)
 
-        query, params = qb.build()
-        logger.debug(query)
-        self.cursor.execute(query, params)
-        return self.cursor.fetchall()
+            return qb.build()[0]
+
+        query = self.compiled(('releasing', len(keep_types), tuple(add_cols), has_past, has_fut,
+                               tuple(c['condition'] for c in o_condition), order), build)
+
+        params = list(keep_types) * 2
+        if has_past:
+            params.append(f'-{d_past} days')
+        if has_fut:
+            params.append(f'+{d_fut} days')
+        for cond in o_condition:
+            params.extend(cond.get('params', ()))
+
+        logger.debug(query.sql)
+        return query.execute(self.cursor, params).fetchall()
 
         """
         SELECT
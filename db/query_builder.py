@@ -1,3 +1,7 @@
+import threading
+
+from collections import OrderedDict
+
 class QueryBuilder:
     def __init__(self):
         self._select = '*'
@@ -99,4 +103,49 @@ class UpdateQuery(QueryBuilder):
         if self._where:
             query += ' WHERE ' + ' AND '.join(self._where)
         
-        return query, self._values + self._params
\ No newline at end of file
+        return query, self._values + self._params
+
+
+class CompiledQuery:
+    '''
+    A query whose text was assembled once, the parameters are bound at execution
+    '''
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def execute(self, cursor, params=()):
+        cursor.execute(self.sql, params)
+        return cursor
+
+class QueryCache:
+    '''
+    Cache of the compiled queries keyed by their shape (everything but the
+    parameters), the text of each shape is assembled once and the same string
+    is executed every time, so sqlite3 also reuses its prepared statement,
+    the least recently used shapes are dropped once the cache is full
+    '''
+
+    def __init__(self, size=256):
+        self._queries = OrderedDict()
+        self._size = size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build):
+        with self._lock:
+            query = self._queries.get(key)
+            if query is not None:
+                self._queries.move_to_end(key)
+                self.hits += 1
+                return query
+
+        query = CompiledQuery(build())
+
+        with self._lock:
+            self.misses += 1
+            self._queries[key] = query
+            if len(self._queries) > self._size:
+                self._queries.popitem(last=False)
+        return query
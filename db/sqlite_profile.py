@@ -0,0 +1,97 @@
+import sqlite3
+import logging
+
+from configparser import ConfigParser
+
+logger = logging.getLogger(__name__)
+
+'''
+The connection profile shared by every SQLite database of the project,
+WAL lets the readers (e.g. the acknowledge server) work while the refresh
+writes, and with WAL synchronous=NORMAL only syncs on checkpoints
+'''
+
+DEFAULTS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,
+    'cache_size': -16000,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 30000,
+}
+
+CHOICES = {
+    'journal_mode': ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF'),
+    'synchronous': ('OFF', 'NORMAL', 'FULL', 'EXTRA', '0', '1', '2', '3'),
+    'temp_store': ('DEFAULT', 'FILE', 'MEMORY', '0', '1', '2'),
+}
+
+def load_profile(config: ConfigParser, section: str = 'SQLITE') -> dict:
+    '''
+    Reads the connection profile from a configuration,
+    the options missing or not valid keep their default
+
+    Parameters:
+        config (ConfigParser): The configuration to read
+        section (str): The section of the profile
+
+    Returns:
+        dict: The value of each pragma
+    '''
+    profile = dict(DEFAULTS)
+
+    for name, default in DEFAULTS.items():
+        value = config.get(section, name, fallback=None)
+        if not value:
+            continue
+
+        if name in CHOICES:
+            value = value.strip().upper()
+            if value not in CHOICES[name]:
+                logger.error(f"Invalid value for {name}: '{value}', using {default}")
+                continue
+        else:
+            try:
+                value = int(value)
+            except ValueError:
+                logger.error(f"Invalid value for {name}: '{value}', using {default}")
+                continue
+
+        profile[name] = value
+
+    return profile
+
+def apply_profile(conn: sqlite3.Connection, profile: dict | None = None):
+    '''
+    Applies a connection profile to an open connection
+
+    Parameters:
+        conn (sqlite3.Connection): The connection
+        profile (dict | None): The value of each pragma, the defaults if None
+    '''
+    profile = profile or DEFAULTS
+
+    for name in ('busy_timeout', 'journal_mode', 'synchronous',
+                 'mmap_size', 'cache_size', 'temp_store'):
+        conn.execute(f'PRAGMA {name} = {profile.get(name, DEFAULTS[name])}')
+
+def connect(path: str, profile: dict | None = None, **kwargs) -> sqlite3.Connection:
+    '''
+    Opens a connection with the connection profile applied
+
+    Parameters:
+        path (str): The path of the database
+        profile (dict | None): The value of each pragma, the defaults if None
+        **kwargs: The other arguments of sqlite3.connect
+
+    Returns:
+        sqlite3.Connection: The connection
+    '''
+    profile = profile or DEFAULTS
+    kwargs.setdefault('timeout', profile.get('busy_timeout', DEFAULTS['busy_timeout']) / 1000)
+    #room for the prepared statements of the compiled queries (see db.query_builder.QueryCache)
+    kwargs.setdefault('cached_statements', 256)
+
+    conn = sqlite3.connect(path, **kwargs)
+    apply_profile(conn, profile)
+    return conn
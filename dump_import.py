@@ -0,0 +1,322 @@
+import os
+import bz2
+import lzma
+import json
+import logging
+
+from datetime import datetime as dt
+
+from db.db_handler import CONFLICT as CON
+from db.music_db import MusicDB as MDB
+
+logger = logging.getLogger(__name__)
+
+class DumpImporter:
+    '''
+    Class to bootstrap the database from the MusicBrainz JSON data dumps
+
+    The dumps are read one line at a time, only the artists listed in the
+    artists file and their release groups are kept, the rows are written
+    in chunks so the memory used does not depend on the size of the dump
+
+    Attributes:
+        __db (MDB): The database object
+        __chunk (int): The number of release groups written at once
+        __ts_fmt (str): The timestamp format of the releases table
+    '''
+
+    def __init__(self, db: MDB, chunk: int = 1000):
+        self.__db = db
+        self.__chunk = chunk
+        self.__ts_fmt = '%Y-%m-%d %H:%M:%S'
+
+    def load(self, paths: list[str], wanted: list[str], since: str,
+             dumped_at: str | None = None) -> list[str]:
+        '''
+        Loads the artists and release groups found in the dump files,
+        artist dumps are always read before release group dumps
+
+        Parameters:
+            paths (list): The dump files (plain, .bz2 or .xz, one JSON entity per line)
+            wanted (list): The names of the artists to import
+            since (str): The minimum first release date (YYYY-MM-DD)
+            dumped_at (str | None): The time the dumps were created (ISO 8601),
+                                    read from their TIMESTAMP file if None
+
+        Returns:
+            list: The names of the artists imported from the dumps
+        '''
+
+        kinds = {path: self.__kind(path) for path in paths}
+        when = self.__dump_time(paths, dumped_at)
+        imported = []
+
+        for path in [p for p in paths if kinds[p] == 'artist']:
+            imported += self.__load_artists(path, wanted)
+
+        matched = [mbid for mbid, _, _ in imported]
+        for path in [p for p in paths if kinds[p] == 'release-group']:
+            self.__load_release_groups(path, since, matched, when)
+
+        for path in [p for p in paths if kinds[p] is None]:
+            logger.error('Unrecognized dump file: ' + path)
+
+        return [name for _, name, _ in imported]
+
+    def __dump_time(self, paths: list[str], value: str | None) -> dt | None:
+        '''
+        Gets the time the dumps were created, from the value given or
+        from the TIMESTAMP file shipped with the dumps, in the folder
+        of a dump file or in its parent (e.g. next to mbdump/)
+
+        Parameters:
+            paths (list): The dump files
+            value (str | None): The time given on the command line
+
+        Returns:
+            datetime: The time the dumps were created
+            None: If it is not known
+        '''
+
+        sources = [('--dump-time', value)] if value else []
+        if not value:
+            for path in paths:
+                folder = os.path.dirname(os.path.abspath(path))
+                for ts_path in (os.path.join(folder, 'TIMESTAMP'),
+                                os.path.join(os.path.dirname(folder), 'TIMESTAMP')):
+                    if os.path.isfile(ts_path):
+                        with open(ts_path) as file:
+                            sources.append((ts_path, file.read().strip()))
+
+        for source, text in sources:
+            try:
+                return dt.fromisoformat(text).astimezone()
+            except ValueError:
+                logger.error(f"Invalid dump time in {source}: '{text}'")
+
+        logger.warning('The time the dumps were created is not known, '
+                       'the artists will be refreshed as usual')
+        return None
+
+    def __open(self, path: str):
+        '''
+        Opens a dump file as text, decompressing it on the fly
+
+        Parameters:
+            path (str): The path of the dump file
+
+        Returns:
+            file: The text stream of the dump
+        '''
+
+        if path.endswith('.bz2'):
+            return bz2.open(path, 'rt', encoding='utf-8')
+        if path.endswith('.xz'):
+            return lzma.open(path, 'rt', encoding='utf-8')
+        return open(path, encoding='utf-8')
+
+    def __entities(self, path: str):
+        '''
+        Yields the entities of a dump file one at a time
+
+        Parameters:
+            path (str): The path of the dump file
+
+        Returns:
+            generator: The decoded entities
+        '''
+
+        with self.__open(path) as file:
+            for line in file:
+                if line.isspace():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning('Skipping malformed line in ' + path)
+
+    def __kind(self, path: str) -> str | None:
+        '''
+        Detects the entity type of a dump from its first entity
+
+        Parameters:
+            path (str): The path of the dump file
+
+        Returns:
+            str: 'artist' or 'release-group'
+            None: If the type cannot be detected
+        '''
+
+        with self.__open(path) as file:
+            for line in file:
+                if line.isspace():
+                    continue
+                try:
+                    entity = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if 'artist-credit' in entity and 'primary-type' in entity:
+                    return 'release-group'
+                if 'sort-name' in entity:
+                    return 'artist'
+                return None
+        return None
+
+    def __load_artists(self, path: str, wanted: list[str]) -> list[tuple]:
+        '''
+        Inserts the wanted artists found in an artist dump,
+        names matching more than one artist are left to the interactive import
+
+        Parameters:
+            path (str): The path of the artist dump
+            wanted (list): The names of the artists to import
+
+        Returns:
+            list: The MBID, name and disambiguation of the artists matched
+        '''
+
+        logger.info('Reading artist dump: ' + path)
+
+        names = {n.casefold() for n in wanted}
+        found = {}
+
+        for a in self.__entities(path):
+            key = a.get('name', '').casefold()
+            if key in names:
+                found.setdefault(key, []).append((a['id'], a['name'], 
+                                                  a.get('disambiguation') or None))
+
+        rows = []
+        for key, matches in found.items():
+            if len(matches) > 1:
+                logger.warning(f'Ambiguous artist in dump: {matches[0][1]} ({len(matches)} matches)')
+                continue
+            rows.append(matches[0])
+
+        self.__db.insert_many('artists', ('mbid', 'name', 'disambiguation'), 
+                              rows, CON.IGNORE)
+
+        logger.info(f'Imported {len(rows)} artists from dump, {len(names) - len(found)} not found')
+        return rows
+
+    def __load_release_groups(self, path: str, since: str, matched: list[str], 
+                              dumped_at: dt | None):
+        '''
+        Inserts the release groups of the known artists found in a release group dump,
+        the artists matched in the artist dump and never refreshed are then marked
+        as refreshed at the time the dump was created, if it is known
+
+        Parameters:
+            path (str): The path of the release group dump
+            since (str): The minimum first release date (YYYY-MM-DD)
+            matched (list): The MBIDs of the artists matched in the artist dump
+            dumped_at (datetime | None): The time the dump was created
+        '''
+
+        logger.info('Reading release group dump: ' + path)
+
+        artists = {mbid: id for id, mbid in self.__db.fetchall('artists', ['id', 'mbid'])}
+
+        chunk = []
+        total = 0
+        seen = set()
+
+        for rg in self.__entities(path):
+            rd = rg.get('first-release-date') or ''
+            if rd < since:
+                continue
+
+            for credit in rg.get('artist-credit', []):
+                a_id = artists.get(credit.get('artist', {}).get('id'))
+                if a_id:
+                    chunk.append((rg, a_id))
+                    seen.add(a_id)
+                    break
+
+            if len(chunk) >= self.__chunk:
+                total += self.__flush(chunk, dumped_at)
+                chunk = []
+
+        total += self.__flush(chunk, dumped_at)
+
+        '''
+        The dump holds every release group of the artists it lists, so the
+        ones never refreshed are up to date as of the time it was created,
+        the other artists were not in the dump and are left to the refresh
+        '''
+        if dumped_at:
+            for i in range(0, len(matched), 500):
+                part = tuple(matched[i:i + 500])
+                self.__db.update('artists', 
+                                 columns=('last_updated',),
+                                 values=(int(dumped_at.timestamp()),),
+                                 condition=[{'condition': 'last_updated IS NULL', 'params': ()},
+                                            {'condition': 'mbid IN (' + ', '.join(['?' for _ in part]) + ')',
+                                             'params': part}])
+
+        logger.info(f'Imported {total} release groups from dump for {len(seen)} artists')
+
+    def __flush(self, chunk: list, dumped_at: dt) -> int:
+        '''
+        Writes a chunk of release groups and their secondary types
+
+        Parameters:
+            chunk (list): The release groups and the ID of their artist
+            dumped_at (datetime | None): The time the dump was created, now if not known
+
+        Returns:
+            int: The number of release groups written
+        '''
+
+        if not chunk:
+            return 0
+
+        ts = (dumped_at or dt.now()).strftime(self.__ts_fmt)
+        rows = []
+        st_ids = []
+
+        for rg, a_id in chunk:
+            tid = self.__type_id(rg.get('primary-type') or 'Other')
+            st = [self.__db.get_type_id(t) for t in rg.get('secondary-types') or []]
+            st = [t for t in st if t]
+            st_ids.append(st)
+
+            fp = self.__db.release_fingerprint(rg['title'], rg['first-release-date'], tid, st)
+            rows.append((rg['id'], a_id, rg['title'], rg['first-release-date'], ts, tid, fp))
+
+        self.__db.insert_many('releases', 
+                              ('mbid', 'artist_mbid', 'title', 'release_date', 
+                               'last_updated', 'primary_type', 'fingerprint'),
+                              rows, CON.IGNORE)
+
+        #older SQLite builds allow at most 999 parameters per statement
+        ids = {}
+        for i in range(0, len(rows), 500):
+            part = [r[0] for r in rows[i:i + 500]]
+            ids.update(self.__db.fetchall('releases', ['mbid', 'id'],
+                                          wheres=[{'condition': 'mbid IN (' + ', '.join(['?' for _ in part]) + ')',
+                                                   'params': part}]))
+
+        types = []
+        for (rg, _), st in zip(chunk, st_ids):
+            types += [(stid, ids[rg['id']]) for stid in st]
+
+        self.__db.insert_many('types_releases', rows=types, conflict=CON.IGNORE)
+
+        return len(rows)
+
+    def __type_id(self, name: str) -> int:
+        '''
+        Gets the ID of a release type, adding it if it is missing
+
+        Parameters:
+            name (str): The name of the type
+
+        Returns:
+            int: The ID of the type
+        '''
+
+        tid = self.__db.get_type_id(name)
+        if not tid:
+            tid = self.__db.insert('types', columns=('name',), values=(name,))
+        return tid
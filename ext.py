@@ -19,6 +19,14 @@ The arguments parser is also defined here with the following options:
     -n, --notify: Notify new releases to telegram
     -a, --auto: Auto mode for artists select, no user input
     -p, --pick-artists: Pick artists to refresh
+    -d, --dump: MusicBrainz JSON dump files to bootstrap the database from
+    --dump-time: Time the dumps were created
+    --record: Record the MusicBrainz traffic to a cassette file
+    --replay: Replay the MusicBrainz traffic from a cassette file
+    --replay-latency: Simulated latency of replayed requests
+    -b, --budget: Maximum requests (e.g. 500) or time (e.g. 30m) spent refreshing
+    -D, --daemon: Keep running and refresh the artists as they become due
+    -B, --batch: Import the artists without user input, ambiguous ones go to a review file
 It also moves the working directory to the folder where the script is located
 And defines a shorthand for the datetime.now function
 '''
@@ -53,11 +61,41 @@ argparser.add_argument('-a', '--auto',
 argparser.add_argument('-p', '--pick-artists',
                        help='Pick artists to refresh',
                        required=False)
+argparser.add_argument('-d', '--dump',
+                       help='MusicBrainz JSON dump files (artist and release-group) to bootstrap the database from',
+                       nargs='+',
+                       required=False)
+argparser.add_argument('--dump-time',
+                       help='Time the dumps were created (e.g. 2024-09-04 00:00:00+00:00), '
+                            'read from the TIMESTAMP file next to them if missing',
+                       required=False)
+cassette_group = argparser.add_mutually_exclusive_group()
+cassette_group.add_argument('--record',
+                            help='Record the MusicBrainz traffic to a cassette file',
+                            required=False)
+cassette_group.add_argument('--replay',
+                            help='Replay the MusicBrainz traffic from a cassette file',
+                            required=False)
+argparser.add_argument('--replay-latency',
+                       help='Seconds to wait for each replayed request, or "recorded"',
+                       required=False)
+argparser.add_argument('-b', '--budget',
+                       help='Maximum requests (e.g. 500) or time (e.g. 90s, 30m, 1h) spent refreshing, '
+                            'the most valuable artists are refreshed first',
+                       required=False)
+argparser.add_argument('-D', '--daemon',
+                       help='Keep running and refresh the artists as they become due, '
+                            'rebuilding the outputs only when the releases change',
+                       action='store_true')
+argparser.add_argument('-B', '--batch',
+                       help='Import the artists without user input, several per request, '
+                            'the ambiguous ones are written to a review file',
+                       action='store_true')
 
 args = argparser.parse_args()
 
-if not args.type and not args.notify:
-    argparser.error('No action requested, add -t or -n')
+if not args.type and not args.notify and not args.dump:
+    argparser.error('No action requested, add -t, -n or -d')
 
 def setup_logger():
     format = '[%(asctime)s]'
@@ -1,25 +1,254 @@
+import time
+import random
 import requests
 import logging
-import time
+import threading
 
-from urllib.parse import urlencode
+from datetime import datetime as dt, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlencode, urlparse
+from requests.adapters import HTTPAdapter
 
 from ext import config
+from rate_limiter import RateLimiter
+from response_cache import ResponseCache
+from cassette import Cassette, CassetteMiss
+from db.sqlite_profile import load_profile
 
 logger = logging.getLogger(__name__)
 
+class MBError(Exception):
+    '''
+    Raised when a request to MusicBrainz keeps failing after every retry
+    '''
+
+class CircuitOpen(MBError):
+    '''
+    Raised when the circuit breaker gave up on a degraded service
+    '''
+
+class CircuitBreaker:
+    '''
+    Class to stop hammering a degraded service
+
+    After a number of consecutive failures the circuit opens and every
+    request waits for the cooldown before a new attempt is allowed,
+    if the circuit opens too many times the run is stopped
+
+    Attributes:
+        __threshold (int): The consecutive failures that open the circuit
+        __cooldown (float): The seconds the circuit stays open
+        __max_trips (int): The times the circuit can open before giving up
+        __failures (int): The current number of consecutive failures
+        __trips (int): The number of times the circuit opened without a success in between
+        __opened_at (float): The time the circuit last opened (None if closed)
+        __lock (threading.Lock): Protects the state from concurrent workers
+    '''
+
+    def __init__(self, threshold: int = 5, cooldown: float = 120, max_trips: int = 3):
+        self.__threshold = threshold
+        self.__cooldown = cooldown
+        self.__max_trips = max_trips
+        self.__failures = 0
+        self.__trips = 0
+        self.__opened_at = None
+        self.__lock = threading.Lock()
+
+    def before(self):
+        '''
+        Waits for the cooldown if the circuit is open
+
+        Raises:
+            CircuitOpen: If the circuit opened more than the allowed times
+        '''
+
+        with self.__lock:
+            if self.__opened_at is None:
+                return
+            if self.__trips > self.__max_trips:
+                raise CircuitOpen(f'MusicBrainz did not recover after {self.__trips} pauses, giving up')
+            wait = self.__opened_at + self.__cooldown - time.time()
+
+        if wait > 0:
+            logger.warning(f'MusicBrainz looks degraded, pausing for {wait:.0f}s')
+            time.sleep(wait)
+
+    def success(self):
+        '''
+        Closes the circuit after a successful request
+        '''
+
+        with self.__lock:
+            self.__failures = 0
+            self.__trips = 0
+            self.__opened_at = None
+
+    def failure(self):
+        '''
+        Records a failed request, opening the circuit when the threshold is reached
+        '''
+
+        with self.__lock:
+            self.__failures += 1
+            t = time.time()
+            is_open = self.__opened_at is not None and t < self.__opened_at + self.__cooldown
+
+            if self.__failures >= self.__threshold and not is_open:
+                self.__opened_at = t
+                self.__trips += 1
+                logger.error(f'Circuit opened after {self.__failures} consecutive failures')
+
 class MBR:
     '''
     Class to interact with the MusicBrainz API
 
     Attributes:
-        __last_request (int): The timestamp of the last request
         __b_url (str): The base url of the API
+        __limiter (RateLimiter): The rate limiter of the endpoint shared with the other processes (None if unlimited)
+        __cache (ResponseCache): The on-disk cache of the responses (None if disabled)
+        rg_mode (str): How release groups are fetched, 'search' filters by date on the server, 'browse' pages through all of them
+        workers (int): The number of threads allowed to query the endpoint concurrently
+        __timeout (float): The timeout in seconds of a single request
+        __pool_size (int): The number of connections kept alive per host
+        __session (requests.Session): The pooled session shared by every request
+        __n_requests (int): The number of requests sent through the session
+        __lock (threading.Lock): Protects the request counter from concurrent workers
+        __retries (int): The number of retries of a failed request
+        __backoff_base (float): The delay in seconds before the first retry
+        __backoff_max (float): The upper bound of the delay between retries
+        __breaker (CircuitBreaker): The circuit breaker shared by every request
+        __cassette (Cassette): The cassette recording or replaying the traffic (None if unused)
     '''
 
-    def __init__(self):
-        self.__last_request = 0
-        self.__b_url = 'http://musicbrainz.org/ws/2/'
+    def __init__(self, cassette: Cassette | None = None):
+        self.__b_url = config.get('MB', 'url', fallback='http://musicbrainz.org/ws/2/')
+        if not self.__b_url.endswith('/'):
+            self.__b_url += '/'
+        self.__cassette = cassette
+        '''
+        The cache is bypassed while recording, so that every request reaches the cassette,
+        and while replaying, so that replays are deterministic, no rate limit applies to a replay
+        '''
+        self.__limiter = self.__new_limiter() if not (cassette and cassette.replaying) else None
+        self.__cache = self.__new_cache() if not cassette else None
+        self.rg_mode = config.get('MB', 'rg_mode', fallback='search')
+        self.workers = max(config.getint('MB', 'workers', fallback=1), 1)
+        self.__timeout = config.getfloat('MB', 'timeout', fallback=10)
+        self.__pool_size = max(config.getint('MB', 'pool_size', fallback=4), self.workers)
+        self.__session = self.__new_session()
+        self.__n_requests = 0
+        self.__lock = threading.Lock()
+        self.__retries = config.getint('MB', 'retries', fallback=4)
+        self.__backoff_base = config.getfloat('MB', 'backoff', fallback=1)
+        self.__backoff_max = config.getfloat('MB', 'backoff_max', fallback=60)
+        self.__breaker = CircuitBreaker(config.getint('MB', 'breaker_threshold', fallback=5),
+                                        config.getfloat('MB', 'breaker_cooldown', fallback=120),
+                                        config.getint('MB', 'breaker_trips', fallback=3))
+
+    def __new_limiter(self) -> RateLimiter | None:
+        '''
+        Creates the rate limiter of the configured endpoint,
+        each endpoint host gets its own bucket in the shared state file
+
+        Returns:
+            RateLimiter: The rate limiter of the endpoint
+            None: If the endpoint has no rate limit (rate <= 0)
+        '''
+
+        rate = config.getfloat('MB', 'rate', fallback=1)
+        if rate <= 0:
+            logger.debug('No rate limit for ' + self.__b_url)
+            return None
+
+        return RateLimiter(config.get('MB', 'limiter_path', fallback='db/mb_rate.db'),
+                           name=urlparse(self.__b_url).netloc,
+                           rate=rate,
+                           burst=config.getfloat('MB', 'burst', fallback=1),
+                           profile=load_profile(config))
+
+    def __new_session(self) -> requests.Session:
+        '''
+        Creates the keep-alive session used for every request,
+        the headers are computed once and reused for the whole run
+
+        Returns:
+            requests.Session: The configured session
+        '''
+
+        adapter = HTTPAdapter(pool_connections=self.__pool_size,
+                              pool_maxsize=self.__pool_size)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({
+            'User-Agent': f"MusicBrainz Release Calendar/0.1 ({config['CREDS']['mail']})",
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        })
+        return session
+
+    def __new_cache(self) -> ResponseCache | None:
+        '''
+        Creates the response cache from the CACHE section of the configuration
+
+        Returns:
+            ResponseCache: The response cache
+            None: If no path for the cache was specified
+        '''
+
+        path = config.get('CACHE', 'path', fallback='db/mb_cache.db')
+        if not path:
+            return None
+
+        ttls = {'artist': config.getint('CACHE', 'ttl_artist', fallback=30 * 86400),
+                'release-group': config.getint('CACHE', 'ttl_release-group', fallback=6 * 3600)}
+
+        return ResponseCache(path, ttls,
+                             config.getint('CACHE', 'max_size', fallback=64 * 1024 * 1024),
+                             load_profile(config))
+
+    def stats(self) -> dict:
+        '''
+        Returns the connection reuse statistics of the session
+
+        Returns:
+            dict: The number of requests sent, connections opened and reused
+        '''
+
+        #the same adapter is mounted for http:// and https://, each one is counted once
+        opened = 0
+        for adapter in set(self.__session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                opened += pools[key].num_connections
+
+        s = {'requests': self.__n_requests,
+             'connections': opened,
+             'reused': max(self.__n_requests - opened, 0)}
+
+        if self.__cache:
+            s.update(self.__cache.stats())
+        return s
+
+    def close(self):
+        '''
+        Logs the connection statistics and closes the session
+        '''
+
+        s = self.stats()
+        logger.info(f"MusicBrainz requests: {s['requests']}, "
+                    f"connections opened: {s['connections']}, "
+                    f"reused: {s['reused']}")
+        if self.__cache:
+            logger.info(f"Cache hits: {s['hits']}, misses: {s['misses']}")
+            self.__cache.close()
+        self.__session.close()
+        if self.__limiter:
+            self.__limiter.close()
+        if self.__cassette:
+            self.__cassette.close()
 
     def search_artist(self, artist: str, limit: int = 5) -> list:
         '''
@@ -31,6 +260,9 @@ class MBR:
 
         Returns:
             list: A list of found artists
+
+        Raises:
+            MBError: If MusicBrainz could not be reached
         '''
         r = self.__get('artist', query=artist, limit=limit)
         if r is None:
@@ -48,12 +280,66 @@ class MBR:
 
         Returns:
             list: A list of found release groups
+
+        Raises:
+            MBError: If MusicBrainz could not be reached or rejected the request
         '''
-        r = self.__get('release-group', artist=mbid, limit=limit, offset=offset)
+        r = self.__get('release-group', allow_rejected=False, 
+                       artist=mbid, limit=limit, offset=offset)
         if r is None:
             return []
         return r['release-groups']
 
+    def search_release_groups(self, mbids: str | list, since: str, 
+                              limit: int, offset: int = 0) -> tuple[list, int]:
+        '''
+        Searches the release groups of one or more artists first released on or after a date,
+        the date filter is applied by the server so old release groups are never downloaded
+
+        Parameters:
+            mbids (str | list): The MusicBrainz ID of the artist or a list of IDs
+            since (str): The minimum first release date (YYYY-MM-DD)
+            limit (int): The number of results to return
+            offset (int): The offset of the results
+
+        Returns:
+            tuple: The list of found release groups and the total number of matches
+
+        Raises:
+            MBError: If MusicBrainz could not be reached or rejected the request
+        '''
+        if isinstance(mbids, str):
+            mbids = [mbids]
+
+        arids = ' OR '.join([f'arid:{mbid}' for mbid in mbids])
+        query = f'({arids}) AND firstreleasedate:[{since} TO *]'
+        r = self.__get('release-group', allow_rejected=False, 
+                       query=query, limit=limit, offset=offset)
+        if r is None:
+            return [], 0
+        return r['release-groups'], r['count']
+
+    def search_artists(self, artists: list[str], limit: int = 100) -> list:
+        '''
+        Searches for several artists in the MusicBrainz database with a single request
+
+        Parameters:
+            artists (list): The names of the artists
+            limit (int): The number of results to return
+
+        Returns:
+            list: A list of found artists, matching any of the names
+
+        Raises:
+            MBError: If MusicBrainz could not be reached
+        '''
+        phrases = [a.replace('\\', '\\\\').replace('"', '\\"') for a in artists]
+        query = ' OR '.join(['artist:"' + p + '"' for p in phrases])
+        r = self.__get('artist', query=query, limit=limit)
+        if r is None:
+            return []
+        return r['artists']
+
     def __url_encode(self, data: dict) -> str:
         '''
         Encodes a dictionary into a url string
@@ -66,34 +352,145 @@ class MBR:
         '''
         if isinstance(data, dict):
             return urlencode(data)
-        
-    def  __get(self, verb: str, **kw) -> dict | None:
+
+    def __retry_after(self, value: str | None) -> float | None:
+        '''
+        Parses the Retry-After header of a response
+
+        Parameters:
+            value (str | None): The header value, in seconds or as an HTTP date
+
+        Returns:
+            float: The number of seconds to wait
+            None: If the header is missing or invalid
         '''
-        Sends a GET request to the MusicBrainz API
+
+        if not value:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            return max((parsedate_to_datetime(value) - dt.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            return None
+
+    def __backoff(self, attempt: int) -> float:
+        '''
+        Computes the delay before retrying a failed request,
+        exponential in the number of attempts, bounded and jittered
+
+        Parameters:
+            attempt (int): The number of the failed attempt (0 based)
+
+        Returns:
+            float: The number of seconds to wait
+        '''
+
+        return min(self.__backoff_max, self.__backoff_base * 2 ** attempt) * random.uniform(0.5, 1)
+
+    def __send(self, verb: str, params: dict, url: str):
+        '''
+        Sends a single request, through the network or from the cassette
 
         Parameters:
             verb (str): The verb of the request
+            params (dict): The query parameters
+            url (str): The full url of the request
+
+        Returns:
+            requests.Response | CassetteResponse: The response of the request
+
+        Raises:
+            MBError: If the request is not in the replayed cassette
+        '''
+
+        if self.__cassette and self.__cassette.replaying:
+            try:
+                return self.__cassette.replay(verb, params, url)
+            except CassetteMiss as e:
+                raise MBError('Request not found in cassette: ' + str(e.args[0])) from None
+
+        start = time.perf_counter()
+        response = self.__session.get(url, timeout=self.__timeout)
+
+        if self.__cassette:
+            self.__cassette.record(verb, params, response, time.perf_counter() - start)
+        return response
+
+    def  __get(self, verb: str, allow_rejected: bool = True, **kw) -> dict | None:
+        '''
+        Sends a GET request to the MusicBrainz API,
+        retrying with backoff on connection errors, 429 and 5xx responses
+
+        Parameters:
+            verb (str): The verb of the request
+            allow_rejected (bool): Whether a rejected request (e.g. 400 or 403) returns None,
+                                   False raises MBError so no result is taken for an empty one
             kw (dict): The query parameters
 
         Returns:
             dict: The response of the request
+            None: If the request was rejected (404, or any 4xx if allow_rejected is set)
+
+        Raises:
+            MBError: If the request still fails after every retry, or it was rejected
+                     and allow_rejected is not set
+            CircuitOpen: If the service is degraded and the run should stop
         '''
 
-        r_url = self.__b_url + verb + '/'
+        if self.__cache:
+            cached = self.__cache.get(verb, kw)
+            if cached is not None:
+                return cached
 
-        #to respect the rate limit of 1 request per second
-        if time.time() - self.__last_request < 1:
-            logger.debug('sleep 1s')
-            time.sleep(1)
-        
+        r_url = self.__b_url + verb + '/'
         r_url += '?' + self.__url_encode(kw) + "&fmt=json"
 
-        hdr = {'User-Agent': f"MusicBrainz Release Calendar/0.1 ({config['CREDS']['mail']})"}
+        for attempt in range(self.__retries + 1):
+            self.__breaker.before()
+
+            #to respect the rate limit shared by every running process
+            if self.__limiter:
+                self.__limiter.acquire()
+
+            retry_after = None
+            try:
+                request = self.__send(verb, kw, r_url)
+                status = request.status_code
+                logger.debug('Requesting ' + request.url)
+            except requests.RequestException as e:
+                logger.warning('Request to ' + r_url + ' failed: ' + str(e))
+                status = None
+            finally:
+                with self.__lock:
+                    self.__n_requests += 1
+
+            if status == 200:
+                self.__breaker.success()
+                if self.__limiter:
+                    self.__limiter.succeeded()
+                response = request.json()
+                if self.__cache:
+                    self.__cache.put(verb, kw, response)
+                return response
+
+            if status is not None and status < 500 and status != 429:
+                self.__breaker.success()
+                if status != 404 and not allow_rejected:
+                    raise MBError(f'Request to {r_url} rejected with status {status}')
+                logger.debug(f'Request to {r_url} rejected with status {status}')
+                return None
+
+            if status in (429, 503):
+                retry_after = self.__retry_after(request.headers.get('Retry-After'))
+                if self.__limiter:
+                    self.__limiter.throttled(retry_after)
+
+            self.__breaker.failure()
 
-        request = requests.get(r_url, headers=hdr)
-        logger.debug('Requesting ' + request.url)
-        self.__last_request = time.time()
+            if attempt < self.__retries and not (retry_after is not None and self.__limiter):
+                delay = self.__backoff(attempt)
+                logger.debug(f'Retrying in {delay:.1f}s (status {status})')
+                time.sleep(delay)
 
-        if request.status_code == 200:
-            return request.json()
-        return None
\ No newline at end of file
+        raise MBError(f'Request to {r_url} failed after {self.__retries + 1} attempts')
@@ -4,6 +4,7 @@ import logging
 from datetime import datetime as dt, timedelta as td, date
 from ext import now
 
+from db.db_handler import Deferred
 from db.music_db import MusicDB as MDB
 
 logger = logging.getLogger(__name__)
@@ -45,9 +46,11 @@ class Notifier:
         __tg_id (str): The telegram chat id
         __n_d (list): The days to notify
         __min_d (int): The minimum day to notify
+        __flush (int): The messages sent recorded in the database at once
     '''
 
-    def __init__(self, db: MDB, tg_id: str, tg_token: str, notify_days: str):
+    def __init__(self, db: MDB, tg_id: str, tg_token: str, notify_days: str,
+                 flush: int = 20):
         self.__db = db
         self.__tg_url = 'https://api.telegram.org/bot'
         self.__mb_url = 'https://musicbrainz.org/release-group/'
@@ -68,14 +71,33 @@ class Notifier:
         self.__tg_url += tg_token 
         self.__n_d = [int(d) for d in notify_days.split(',')]
         self.__min_d = min(self.__n_d)
+        self.__flush = flush
 
     def notify(self, keep_types: list = []):
         '''
         Selects and parses releases that need to be notified,
         then sends them to the telegram chat
 
+        The messages sent are recorded in batches, the database is not
+        locked while waiting for telegram and the records are written
+        even if the run stops halfway
+
+        Parameters:
+            keep_types (list): The types of releases to select
+        '''
+        with self.__db.deferred('releases', 
+                                columns=('last_notified', 'last_msg_id'),
+                                key_columns=('id',),
+                                size=self.__flush) as sent:
+            self.__notify(keep_types, sent)
+
+    def __notify(self, keep_types: list, sent: Deferred):
+        '''
+        Sends the releases that need to be notified
+
         Parameters:
             keep_types (list): The types of releases to select
+            sent (Deferred): The buffer recording the messages sent
         '''
         for release in self.__db.get_releasing(keep_types, None, None,
                                           ['last_notified', 'still_interesting'], 
@@ -133,10 +155,10 @@ class Notifier:
                 't_other': t_other
             }
 
-            self.__send_item(data, is_unsure, s_verb, s_header)
+            self.__send_item(data, is_unsure, s_verb, s_header, sent)
 
     def __send_item(self, data: dict, is_unsure: bool,
-                    s_verb: int, s_header: int):
+                    s_verb: int, s_header: int, sent: Deferred):
         '''
         Shorthand method to both assemble and send a message
 
@@ -145,10 +167,11 @@ class Notifier:
             is_unsure (bool): Whether the release date is uncertain
             s_verb (int): The verb to use in the message
             s_header (int): The header to use in the message
+            sent (Deferred): The buffer recording the messages sent
         '''
 
         msg = self.__assemble(data, is_unsure, s_verb, s_header)
-        self.__telegram_send(msg, data['r_title'], data['r_id'], s_header > 0)
+        self.__telegram_send(msg, data['r_title'], data['r_id'], sent, s_header > 0)
 
     def __assemble(self, data: dict, is_unsure: bool,
                    s_verb: int, s_other: int):
@@ -184,7 +207,8 @@ class Notifier:
         
         return msg        
     
-    def __telegram_send(self, msg: str, r_title: str, r_id: str, ack: bool = False):
+    def __telegram_send(self, msg: str, r_title: str, r_id: str, 
+                        sent: Deferred, ack: bool = False):
         '''  
         Sends a message to the configured telegram chat
 
@@ -192,6 +216,7 @@ class Notifier:
             msg (str): The message to send
             r_title (str): The title of the release
             r_id (str): The id of the release
+            sent (Deferred): The buffer recording the messages sent
         '''
 
         inline = [{'text': u'\U0001F44E', 'callback_data': 'unwanted'}]
@@ -216,8 +241,4 @@ class Notifier:
             msg_id = int(result.json()['result']['message_id'])
 
             logger.info(f"Sent notification for {r_title} to telegram")
-            self.__db.update(table='releases', 
-                           columns=('last_notified', 'last_msg_id'),
-                           values=(now(), msg_id), 
-                           condition=[{'condition': 'id = ?', 
-                                        'params': (r_id,)}])
+            sent.add((now(), msg_id, r_id))
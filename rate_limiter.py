@@ -0,0 +1,148 @@
+import time
+import logging
+import threading
+
+from db.sqlite_profile import connect
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    '''
+    Token bucket rate limiter whose state lives in a small SQLite table,
+    so that every process pointing at the same file shares the same budget
+
+    Attributes:
+        __name (str): The name of the bucket (one row per endpoint)
+        __rate (float): The number of tokens added each second
+        __burst (float): The maximum number of tokens the bucket can hold
+        __backoff (float): The delay applied on the next throttled response
+        __max_backoff (float): The upper bound of the throttling delay
+        __lock (threading.Lock): Serializes the threads of this process
+        __conn (sqlite3.Connection): The connection to the state file
+    '''
+
+    def __init__(self, state_path: str, name: str = 'musicbrainz',
+                 rate: float = 1.0, burst: float = 1.0,
+                 max_backoff: float = 60.0, profile: dict | None = None):
+        self.__name = name
+        self.__rate = rate
+        self.__burst = max(burst, 1.0)
+        self.__backoff = 1 / rate
+        self.__max_backoff = max_backoff
+        self.__lock = threading.Lock()
+
+        self.__conn = connect(state_path or ':memory:', profile,
+                              isolation_level=None,
+                              check_same_thread=False)
+        self.__conn.execute('''CREATE TABLE IF NOT EXISTS buckets (
+                                    name TEXT PRIMARY KEY,
+                                    tokens REAL NOT NULL,
+                                    updated REAL NOT NULL,
+                                    blocked_until REAL NOT NULL DEFAULT 0
+                               )''')
+        self.__conn.execute('''INSERT OR IGNORE INTO buckets (name, tokens, updated)
+                               VALUES (?, ?, ?)''',
+                            (name, self.__burst, time.time()))
+
+    def acquire(self):
+        '''
+        Blocks until a token is available, sleeping only the time
+        still missing before the next token is generated
+        '''
+
+        while True:
+            wait = self.__take()
+            if wait <= 0:
+                return
+            logger.debug(f'sleep {wait:.3f}s')
+            time.sleep(wait)
+
+    def throttled(self, retry_after: float | None = None):
+        '''
+        Pauses the bucket for every process after a 503/429 response,
+        if the server did not say how long to wait the delay doubles on
+        every consecutive throttled response
+
+        Parameters:
+            retry_after (float | None): The delay requested by the server
+        '''
+
+        if retry_after is None:
+            delay = self.__backoff
+            self.__backoff = min(self.__backoff * 2, self.__max_backoff)
+        else:
+            delay = min(retry_after, self.__max_backoff)
+
+        logger.warning(f'MusicBrainz is throttling, pausing for {delay:.1f}s')
+
+        self.__transaction('''UPDATE buckets
+                              SET tokens = 0, updated = ?,
+                                  blocked_until = MAX(blocked_until, ?)
+                              WHERE name = ?''',
+                           lambda t: (t, t + delay, self.__name))
+
+    def succeeded(self):
+        '''
+        Resets the throttling delay after a successful response
+        '''
+
+        self.__backoff = 1 / self.__rate
+
+    def close(self):
+        '''
+        Close the connection to the state file
+        '''
+
+        self.__conn.close()
+
+    def __take(self) -> float:
+        '''
+        Refills the bucket and tries to take a token from it
+
+        Returns:
+            float: 0 if a token was taken, otherwise the seconds to wait
+        '''
+
+        with self.__lock:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            try:
+                tokens, updated, blocked = self.__conn.execute(
+                    'SELECT tokens, updated, blocked_until FROM buckets WHERE name = ?',
+                    (self.__name,)).fetchone()
+
+                t = time.time()
+                tokens = min(self.__burst, tokens + max(t - updated, 0) * self.__rate)
+
+                if t < blocked:
+                    wait = blocked - t
+                elif tokens >= 1:
+                    tokens -= 1
+                    wait = 0
+                else:
+                    wait = (1 - tokens) / self.__rate
+
+                self.__conn.execute('UPDATE buckets SET tokens = ?, updated = ? WHERE name = ?',
+                                    (tokens, t, self.__name))
+                self.__conn.execute('COMMIT')
+            except BaseException:
+                self.__conn.execute('ROLLBACK')
+                raise
+        return wait
+
+    def __transaction(self, query: str, params):
+        '''
+        Runs a single statement inside an exclusive transaction
+
+        Parameters:
+            query (str): The statement to execute
+            params (callable): Builds the parameters from the current time
+        '''
+
+        with self.__lock:
+            self.__conn.execute('BEGIN IMMEDIATE')
+            try:
+                self.__conn.execute(query, params(time.time()))
+                self.__conn.execute('COMMIT')
+            except BaseException:
+                self.__conn.execute('ROLLBACK')
+                raise
@@ -0,0 +1,164 @@
+import json
+import time
+import zlib
+import logging
+import threading
+
+from urllib.parse import urlencode
+
+from db.sqlite_profile import connect
+
+logger = logging.getLogger(__name__)
+
+class ResponseCache:
+    '''
+    Disk-backed cache of MusicBrainz responses, keyed by verb and query,
+    with a time to live for each verb and LRU eviction once the stored
+    responses exceed the configured size
+
+    Attributes:
+        __ttls (dict): The time to live in seconds of each verb
+        __max_size (int): The maximum size in bytes of the stored responses
+        __hits (int): The number of lookups served from the cache
+        __misses (int): The number of lookups not found or expired
+        __lock (threading.Lock): Serializes the threads of this process
+        __conn (sqlite3.Connection): The connection to the cache file
+    '''
+
+    def __init__(self, cache_path: str, ttls: dict, max_size: int, 
+                 profile: dict | None = None):
+        self.__ttls = ttls
+        self.__max_size = max_size
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+        self.__conn = connect(cache_path, profile, check_same_thread=False)
+        self.__conn.execute('''CREATE TABLE IF NOT EXISTS responses (
+                                    key TEXT PRIMARY KEY,
+                                    verb TEXT NOT NULL,
+                                    body BLOB NOT NULL,
+                                    size INTEGER NOT NULL,
+                                    stored REAL NOT NULL,
+                                    accessed REAL NOT NULL
+                               )''')
+        self.__conn.execute('''CREATE INDEX IF NOT EXISTS responses_accessed
+                               ON responses (accessed)''')
+        self.__conn.commit()
+
+    def key(self, verb: str, params: dict) -> str:
+        '''
+        Builds the cache key of a request, the parameters are sorted
+        so the same query always maps to the same entry
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+
+        Returns:
+            str: The cache key
+        '''
+
+        return verb + '?' + urlencode(sorted(params.items()))
+
+    def get(self, verb: str, params: dict) -> dict | None:
+        '''
+        Gets a fresh response from the cache
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+
+        Returns:
+            dict: The cached response
+            None: If the response is not cached or expired
+        '''
+
+        ttl = self.__ttls.get(verb, 0)
+        if ttl <= 0:
+            return None
+
+        key = self.key(verb, params)
+        t = time.time()
+
+        with self.__lock:
+            row = self.__conn.execute('SELECT body FROM responses WHERE key = ? AND stored > ?',
+                                      (key, t - ttl)).fetchone()
+            if not row:
+                self.__misses += 1
+                return None
+
+            self.__conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (t, key))
+            self.__conn.commit()
+            self.__hits += 1
+
+        logger.debug('Cache hit: ' + key)
+        return json.loads(zlib.decompress(row[0]))
+
+    def put(self, verb: str, params: dict, response: dict):
+        '''
+        Stores a response in the cache, evicting the least recently
+        used entries if the cache grows over its maximum size
+
+        Parameters:
+            verb (str): The verb of the request
+            params (dict): The query parameters
+            response (dict): The response to store
+        '''
+
+        if self.__ttls.get(verb, 0) <= 0:
+            return
+
+        body = zlib.compress(json.dumps(response).encode('utf-8'))
+        t = time.time()
+
+        with self.__lock:
+            self.__conn.execute('''INSERT OR REPLACE INTO responses
+                                   (key, verb, body, size, stored, accessed)
+                                   VALUES (?, ?, ?, ?, ?, ?)''',
+                                (self.key(verb, params), verb, body, len(body), t, t))
+            self.__evict()
+            self.__conn.commit()
+
+    def stats(self) -> dict:
+        '''
+        Returns the hit and miss counters of the cache
+
+        Returns:
+            dict: The number of hits and misses
+        '''
+
+        return {'hits': self.__hits, 'misses': self.__misses}
+
+    def close(self):
+        '''
+        Close the connection to the cache file
+        '''
+
+        self.__conn.close()
+
+    def __evict(self):
+        '''
+        Deletes the expired entries and then the least recently used ones
+        until the cache fits in its maximum size
+        '''
+
+        t = time.time()
+        for verb, ttl in self.__ttls.items():
+            self.__conn.execute('DELETE FROM responses WHERE verb = ? AND stored <= ?',
+                                (verb, t - ttl))
+
+        size = self.__conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if size <= self.__max_size:
+            return
+
+        freed = 0
+        evict = []
+        for key, s in self.__conn.execute('SELECT key, size FROM responses ORDER BY accessed'):
+            if size - freed <= self.__max_size:
+                break
+            evict.append((key,))
+            freed += s
+
+        self.__conn.executemany('DELETE FROM responses WHERE key = ?', evict)
+        logger.debug(f'Evicted {len(evict)} cached responses ({freed} bytes)')
@@ -0,0 +1,157 @@
+import time
+import logging
+
+from mb import MBR
+from db.music_db import MusicDB as MDB
+
+logger = logging.getLogger(__name__)
+
+class Budget:
+    '''
+    Class to limit the work of a refresh run
+
+    The budget is either a number of requests sent to MusicBrainz (e.g. '500')
+    or a duration with a unit of seconds, minutes or hours (e.g. '90s', '30m', '1h')
+
+    Attributes:
+        __mb (MBR): The MusicBrainz client whose requests are counted
+        __requests (int): The maximum number of requests (None if time based)
+        __seconds (float): The maximum duration in seconds (None if request based)
+        __start_req (int): The requests already sent when the budget started
+        __start (float): The time the budget started
+    '''
+
+    def __init__(self, spec: str, mb: MBR):
+        self.__mb = mb
+        self.__requests = None
+        self.__seconds = None
+
+        spec = spec.strip().lower()
+        units = {'s': 1, 'm': 60, 'h': 3600}
+
+        if spec.isdigit():
+            self.__requests = int(spec)
+        elif spec[:-1].isdigit() and spec[-1] in units:
+            self.__seconds = int(spec[:-1]) * units[spec[-1]]
+        else:
+            raise ValueError("Invalid budget: '" + spec + "'")
+
+        self.__start_req = mb.stats()['requests']
+        self.__start = time.time()
+
+    def exhausted(self) -> bool:
+        '''
+        Checks whether the budget was spent
+
+        Returns:
+            bool: True if no more requests should be sent
+        '''
+
+        if self.__requests is not None:
+            return self.__mb.stats()['requests'] - self.__start_req >= self.__requests
+        return time.time() - self.__start >= self.__seconds
+
+class RefreshScheduler:
+    '''
+    Class to rank the artists to refresh by the expected value of refreshing them
+    and to choose how often each artist should be refreshed
+
+    The score of an artist grows with the time since its last refresh
+    (in units of its refresh interval), it is boosted by how often the
+    artist released something in the last year and by releases announced
+    for the future or with a partial date that is not over yet
+
+    Attributes:
+        __db (MDB): The database object
+        __interval (int): The global refresh interval in seconds
+        __min (int): The shortest refresh interval of an artist in seconds
+        __max (int): The longest refresh interval of an artist in seconds
+        __never (float): The staleness of an artist never refreshed
+    '''
+
+    def __init__(self, db: MDB, interval: int, min_interval: int = 0, max_interval: int = 0):
+        self.__db = db
+        self.__interval = interval if interval > 0 else 86400
+        self.__min = min_interval if min_interval > 0 else self.__interval
+        self.__max = max(max_interval, self.__min)
+        self.__never = 10.0
+
+    def interval(self, recent: int, pending: int, last_release: str | None) -> int:
+        '''
+        Computes the refresh interval of an artist from its release history
+
+        An artist with an announced release is refreshed as often as allowed,
+        an active artist more often than the global interval and an artist
+        whose last release is years old less and less often
+
+        Parameters:
+            recent (int): The releases of the artist in the last year
+            pending (int): The releases of the artist announced or with an open partial date
+            last_release (str | None): The date of the last release already out
+
+        Returns:
+            int: The refresh interval in seconds, within the configured bounds
+        '''
+
+        if pending:
+            return self.__min
+
+        if recent:
+            i = self.__interval / (1 + min(recent, 12) / 4)
+        else:
+            years = 2
+            if last_release:
+                years = max(time.gmtime().tm_year - int(str(last_release)[:4]), 1)
+            i = self.__interval * 2 ** min(years, 10)
+
+        return int(min(max(i, self.__min), self.__max))
+
+    def score(self, last_updated: int | None, recent: int, pending: int,
+              interval: int | None = None) -> float:
+        '''
+        Computes the expected value of refreshing an artist
+
+        Parameters:
+            last_updated (int | None): The time of the last refresh (epoch seconds)
+            recent (int): The releases of the artist in the last year
+            pending (int): The releases of the artist announced or with an open partial date
+            interval (int | None): The refresh interval of the artist (None for the global one)
+
+        Returns:
+            float: The score of the artist
+        '''
+
+        if last_updated is None:
+            staleness = self.__never
+        else:
+            staleness = max(time.time() - int(last_updated), 0) / (interval or self.__interval)
+
+        cadence = min(recent, 12) / 12
+        return staleness * (1 + cadence) + 2 * min(pending, 1)
+
+    def rank(self, artists: list) -> list:
+        '''
+        Sorts the artists by descending score
+
+        Parameters:
+            artists (list): Artist rows, the ID first, then the name third,
+                            the refresh interval and the last refresh time last
+
+        Returns:
+            list: The same rows, highest value first
+        '''
+
+        activity = self.__db.get_artist_activity()
+
+        scored = []
+        for a in artists:
+            recent, pending, _ = activity.get(a[0], (0, 0, None))
+            scored.append((self.score(a[-1], recent, pending, a[-2]), a))
+
+        scored.sort(key=lambda s: s[0], reverse=True)
+
+        if scored:
+            logger.debug(f'Highest score: {scored[0][1][2]} ({scored[0][0]:.2f}), '
+                         f'lowest: {scored[-1][1][2]} ({scored[-1][0]:.2f})')
+
+        return [a for _, a in scored]
@@ -1,9 +1,15 @@
+import os
+import sys
 import requests
-import sqlite3
 from configparser import ConfigParser
 
 from flask import Flask, request
 
+#the server shares the connection profile of the project it lives in
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from db.sqlite_profile import connect, load_profile
+
 config = ConfigParser()
 config.read('config.cfg')
 
@@ -11,13 +17,14 @@ tg_token = config.get('SETTINGS', 'tg_token')
 tg_id = config.get('SETTINGS', 'tg_id')
 
 db_path = config.get('PATHS', 'db')
+db_profile = load_profile(config)
 
 tg_url = f'https://api.telegram.org/bot'
 
 app = Flask(__name__)
 
 def mark_acknowledged(db_path, msg_id):
-    conn = sqlite3.connect(db_path)
+    conn = connect(db_path, db_profile)
     c = conn.cursor()
     c.execute('''
         UPDATE releases SET still_interesting = 0 WHERE last_msg_id = ?